@@ -0,0 +1,529 @@
+#!/usr/bin/env python3
+# encoding: utf8
+
+"""
+Offline benchmarks for wmlparser and the bot.
+
+The payloads are taken from the bot's capture of received traffic
+(log/wesbot_rec.cap and its rotated backups), so the numbers reflect
+what the lobby actually sends. Without a capture a generated lobby
+is used instead.
+
+    python3 benchmark.py lookup
+    python3 benchmark.py engines
+    python3 benchmark.py send
+    python3 benchmark.py --capture log/wesbot_rec.cap memory --engine buffer
+    python3 benchmark.py --capture log/wesbot_rec.cap suite --json
+"""
+
+import argparse
+import ast
+import gc
+import glob
+import json
+import logging
+import time
+import tracemalloc
+
+import wmlparser
+
+
+def load_capture(path):
+    """
+    Returns the payloads captured to path by WesSock (and its rotated
+    backups path.1, path.2, ...) as a list of bytes, oldest first. Both
+    capture files and the text logs of earlier versions can be read.
+    """
+    from rewritebotCAP import isCapture, readCapture
+
+    payloads = []
+    for name in sorted(glob.glob(path + ".*"), reverse=True) + [path]:
+        if isCapture(name):
+            payloads.extend(payload for received, payload in readCapture(name))
+            continue
+        with open(name, "r", encoding="utf8", errors="replace") as f:
+            for line in f:
+                message = line.partition(" - DEBUG - ")[2].rstrip("\n")
+                if message.startswith("b'") or message.startswith('b"'):
+                    payloads.append(ast.literal_eval(message))
+    return payloads
+
+
+def generate_gamelist(games=300, users=1500, map_size=24):
+    """
+    Returns an initial lobby payload with the given number of games
+    and users, shaped like the one wesnothd sends after login. Every
+    game has a map_size by map_size map, like a typical 2p map.
+    """
+    row = b", ".join([b"Gg^Efm", b"Hh", b"Re", b"Ww", b"Ss"] * map_size)[:map_size * 8]
+    map_data = b"\n".join([row] * map_size)
+    parts = [b"[gamelist]\n"]
+    for i in range(games):
+        parts.append(b'[game]\nhuman_sides="2"\nid="%d"\n'
+                     b'map_data="border_size=1\nusage=map\n%s"\n'
+                     b'mp_era="era_default"\nmp_scenario="2p_%d"\n'
+                     b'mp_use_map_settings="yes"\nname="Game %d"\n'
+                     b'observer="yes"\nturn="3/20"\n'
+                     b'[slot_data]\nmax="2"\nvacant="%d"\n[/slot_data]\n'
+                     b'[/game]\n' % (1000 + i, map_data, i, i, i % 2))
+    parts.append(b"[/gamelist]\n")
+    for i in range(users):
+        parts.append(b'[user]\navailable="yes"\ngame_id="%d"\nlocation=""\n'
+                     b'name="user%d"\nregistered="%s"\nstatus="lobby"\n'
+                     b'[/user]\n' % (1000 + i % games, i,
+                                     b"yes" if i % 3 else b"no"))
+    return b"".join(parts)
+
+
+def initial_gamelist(capture):
+    """
+    The first captured payload containing a full [gamelist], or a
+    generated one if there is no capture.
+    """
+    if capture:
+        for payload in load_capture(capture):
+            if b"[gamelist]\n" in payload and b"[gamelist_diff]" not in payload:
+                return payload
+    return generate_gamelist()
+
+
+def generate_gamelist_diff(users, games, insert):
+    """
+    Returns a [gamelist_diff] that either appends a user and a game to
+    a lobby of the given size or removes the last ones again.
+    """
+    if insert:
+        return (b'[gamelist_diff]\n[change_child]\nindex="0"\n[gamelist]\n'
+                b'[insert_child]\nindex="%d"\n[game]\nid="%d"\nname="New game"\n'
+                b'mp_scenario="2p_New"\n[/game]\n[/insert_child]\n'
+                b'[/gamelist]\n[/change_child]\n'
+                b'[insert_child]\nindex="%d"\n[user]\navailable="yes"\n'
+                b'game_id="0"\nlocation=""\nname="joining"\nregistered="no"\n'
+                b'status="lobby"\n[/user]\n[/insert_child]\n[/gamelist_diff]\n'
+                % (games, 1000 + games, users))
+    return (b'[gamelist_diff]\n[change_child]\nindex="0"\n[gamelist]\n'
+            b'[delete_child]\nindex="%d"\n[game]\n[/game]\n[/delete_child]\n'
+            b'[/gamelist]\n[/change_child]\n'
+            b'[delete_child]\nindex="%d"\n[user]\n[/user]\n[/delete_child]\n'
+            b'[/gamelist_diff]\n' % (games, users))
+
+
+def generate_observed(sides=4, units=50, events=100):
+    """
+    Returns a payload like the one received when starting to observe a
+    game: the scenario with its sides, units and events, and a replay.
+    """
+    parts = [b'[scenario]\nid="2p_Observed"\nname=_ "Observed"\n']
+    for side in range(sides):
+        parts.append(b'[side]\nside="%d"\ncontroller="human"\n' % (side + 1))
+        for unit in range(units):
+            parts.append(b'[unit]\nid="Unit-%d-%d"\ntype="Elvish Fighter"\n'
+                         b'x,y=%d,%d\n[modifications]\n[trait]\nid="quick"\n'
+                         b'name=_ "quick"\ndescription=_ "fast" + " and frail"\n'
+                         b'[/trait]\n[/modifications]\n[/unit]\n'
+                         % (side, unit, unit + 1, side + 1))
+        parts.append(b'[/side]\n')
+    for event in range(events):
+        parts.append(b'[event]\nname="turn %d"\n[message]\nspeaker="narrator"\n'
+                     b'message=_ "Turn ""%d""\nhas begun"\n[/message]\n'
+                     b'[lua]\ncode=<<\n    wesnoth.message("%d")\n>>\n[/lua]\n'
+                     b'[/event]\n' % (event, event, event))
+    parts.append(b'[/scenario]\n[replay]\n[command]\n[speak]\nid="user1"\n'
+                 b'message="hello"\n[/speak]\n[/command]\n[/replay]\n')
+    return b"".join(parts)
+
+
+def generate_corpus(diffs=200, whispers=200, observed=5):
+    """
+    Returns a corpus like the one classify_capture gives, with
+    generated payloads that stay consistent with the generated lobby.
+    """
+    games, users = 300, 1500
+    corpus = [("gamelist", generate_gamelist(games, users))]
+    for i in range(diffs):
+        corpus.append(("gamelist_diff",
+                       generate_gamelist_diff(users, games, i % 2 == 0)))
+    for i in range(whispers):
+        corpus.append(("whisper", b'[whisper]\nmessage="message %d"\n'
+                                  b'receiver="wesbot"\nsender="user%d"\n'
+                                  b'[/whisper]\n' % (i, i % users)))
+    for i in range(observed):
+        corpus.append(("observed", generate_observed()))
+    return corpus
+
+
+# Payload categories of the corpus, in the order they are reported.
+CATEGORIES = ("gamelist", "gamelist_diff", "whisper", "observed", "other")
+
+
+def classify(payload):
+    """
+    The category of a received payload.
+    """
+    if b"[gamelist_diff]" in payload:
+        return "gamelist_diff"
+    if b"[gamelist]" in payload:
+        return "gamelist"
+    if b"[whisper]" in payload or b"[message]" in payload[:20]:
+        return "whisper"
+    if b"[scenario]" in payload or b"[replay]" in payload or b"[side]" in payload:
+        return "observed"
+    return "other"
+
+
+def load_corpus(capture):
+    """
+    Returns the (category, payload) pairs of the capture in the order
+    they were received, or a generated corpus if there is no capture.
+    """
+    if capture:
+        corpus = [(classify(payload), payload) for payload in load_capture(capture)]
+        if corpus:
+            return corpus
+    return generate_corpus()
+
+
+def best_of(repeat, function):
+    """
+    Runs function repeat times and returns the fastest time in seconds.
+    """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def scan_text_val(node, name):
+    """
+    Attribute lookup the way TagNode.get_text_val worked before
+    attributes were indexed, by get_all(att=name) checking every child.
+    """
+    x = []
+    for sub in node.data:
+        v = name.encode("utf8")
+        if isinstance(sub, wmlparser.AttributeNode) and sub.name == v:
+            x.append(sub)
+    if not x: return None
+    return x[-1].get_text()
+
+
+USER_ATTRIBUTES = ["available", "game_id", "location", "name", "registered",
+                   "status"]
+GAME_ATTRIBUTES = ["id", "name", "mp_scenario", "mp_era",
+                   "mp_use_map_settings", "observer"]
+
+
+def bench_lookup(args):
+    root = wmlparser.Parser().parse_binary(initial_gamelist(args.capture))
+    nodes = [(user, USER_ATTRIBUTES) for user in root.get_all(tag="user")]
+    for gamelist in root.get_all(tag="gamelist"):
+        nodes += [(game, GAME_ATTRIBUTES) for game in gamelist.get_all(tag="game")]
+    lookups = sum(len(names) for node, names in nodes)
+
+    def indexed():
+        for node, names in nodes:
+            for name in names:
+                node.get_text_val(name)
+
+    def scanned():
+        for node, names in nodes:
+            for name in names:
+                scan_text_val(node, name)
+
+    print("%d users and games, %d attribute lookups" % (len(nodes), lookups))
+    results = {}
+    for name, function in [("scan", scanned), ("index", indexed)]:
+        results[name] = best_of(args.repeat, function)
+        print("%-6s %8.2f ms %10.0f lookups/s" % (
+            name, results[name] * 1000, lookups / results[name]))
+    print("speedup %.1fx" % (results["scan"] / results["index"]))
+
+
+def retained(function):
+    """
+    Calls function and returns its result together with the number of
+    bytes it allocated that are still in use afterwards, and the most
+    it had allocated at once while running.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = function()
+        peak = tracemalloc.get_traced_memory()[1] - before
+        gc.collect()
+        return result, tracemalloc.get_traced_memory()[0] - before, peak
+    finally:
+        tracemalloc.stop()
+
+
+def bench_memory(args):
+    from rewritebotSCHEMA import User, Game
+
+    data = initial_gamelist(args.capture)
+
+    def parse(track_locations):
+        def function():
+            p = wmlparser.Parser()
+            p.engine = args.engine
+            p.track_locations = track_locations
+            return p.parse_binary(data)
+        return function
+
+    def lobby():
+        root = parse(False)()
+        users = [User(node) for node in root.get_all(tag="user")]
+        games = [Game(node) for gamelist in root.get_all(tag="gamelist")
+                 for node in gamelist.get_all(tag="game")]
+        return users, games
+
+    print("payload %.2f MB" % (len(data) / 1e6))
+    print("%-24s %8s %8s" % ("", "kept MB", "peak MB"))
+    for name, function in [("tree with locations", parse(True)),
+                           ("tree without locations", parse(False)),
+                           ("lobby users and games", lobby)]:
+        result, size, peak = retained(function)
+        print("%-24s %8.2f %8.2f" % (name, size / 1e6, peak / 1e6))
+
+
+def bench_engines(args):
+    payloads = load_capture(args.capture) if args.capture else []
+    if not payloads:
+        payloads = [generate_gamelist()]
+    size = sum(len(payload) for payload in payloads)
+
+    def parse(engine):
+        def function():
+            for payload in payloads:
+                p = wmlparser.Parser()
+                p.engine = engine
+                p.track_locations = False
+                p.parse_binary(payload)
+        return function
+
+    print("%d payloads, %.2f MB" % (len(payloads), size / 1e6))
+    for engine in wmlparser.ENGINES:
+        elapsed = best_of(args.repeat, parse(engine))
+        print("%-6s %8.2f ms %8.2f MB/s" % (
+            engine, elapsed * 1000, size / elapsed / 1e6))
+
+
+def generate_outgoing(count=2000):
+    """
+    Returns count (tag, attributes) pairs shaped like what the bot sends:
+    pings to a few users, the same help reply and relayed IRC messages
+    that are all different.
+    """
+    help_message = ("This is IRC-lobby bot written in Python 3.6 by Ravana. "
+                    "Current prefix: !")
+    messages = []
+    for i in range(count):
+        kind = i % 4
+        if kind == 0:
+            messages.append(("whisper", {"message": "ping", "receiver": "user%d" % (i % 5),
+                                         "sender": "spoof"}))
+        elif kind == 1:
+            messages.append(("whisper", {"message": help_message, "receiver": "user%d" % (i % 20),
+                                         "sender": "spoof"}))
+        else:
+            messages.append(("message", {"message": "<irc%d> relayed line number %d" % (i % 7, i),
+                                         "room": ""}))
+    return messages
+
+
+def bench_send(args):
+    from rewritebotCFG import WesSettings
+    from rewritebotCON import FrameEncoder
+
+    messages = generate_outgoing()
+    writer = wmlparser.WMLWriter()
+    level = WesSettings.wesGzipLevel
+
+    def send(encoder, sizes):
+        def function():
+            for tag, attributes in messages:
+                writer.tag(tag, **attributes)
+                sizes.append(len(encoder.frame(writer.getvalue())))
+                writer.reset()
+        return function
+
+    print("%d messages" % len(messages))
+    for name, make in [("level 9, uncached", lambda: FrameEncoder(9, 0)),
+                       ("level %d, uncached" % level, lambda: FrameEncoder(level, 0)),
+                       ("level %d, cached" % level, lambda: FrameEncoder(level))]:
+        sizes = []
+        elapsed = best_of(args.repeat, lambda: send(make(), sizes)())
+        print("%-18s %10.0f msgs/s %6.1f bytes/msg" % (
+            name, len(messages) / elapsed, sum(sizes) / len(sizes)))
+
+
+def null_logger():
+    logger = logging.getLogger("benchmark.null")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    logger.disabled = True
+    return logger
+
+
+class BenchCommands:
+    """
+    Stands in for CommandHandler, only counting the messages it gets.
+    """
+
+    def __init__(self):
+        self.messages = 0
+
+    def onWesMessage(self, message, sender, registered, whisper=False, session=None):
+        self.messages += 1
+
+    def onServerMessage(self, message, private):
+        self.messages += 1
+
+
+class BenchBot:
+    """
+    Just enough of WesBot for an Actor, without sockets or log files.
+    Logging is disabled so that only parsing and lobby updates are
+    measured.
+    """
+
+    def __init__(self):
+        from rewritebotSCHEMA import LobbyHolder
+        from rewritebotACT import Actor
+
+        self.log = self.userLog = self.gameLog = self.messageLog = null_logger()
+        self.commandHandler = BenchCommands()
+        self.lobby = LobbyHolder(self, self.log)
+        self.actor = Actor(self)
+
+
+def parse_target(engine):
+    """
+    Returns a function handling one payload with Parser.parse_binary.
+    """
+    def target():
+        def function(payload):
+            p = wmlparser.Parser()
+            p.engine = engine
+            p.track_locations = False
+            p.parse_binary(payload)
+        return function
+    return target
+
+
+def actor_target():
+    """
+    Returns a function handling one payload with Actor.actOnData. A new
+    bot is made per run since the payloads update its lobby.
+    """
+    return BenchBot().actor.actOnData
+
+
+def run_corpus(corpus, target, repeat):
+    """
+    Handles the corpus in order repeat times and returns the fastest
+    time spent on each category.
+    """
+    best = {}
+    for i in range(repeat):
+        function = target()
+        elapsed = dict.fromkeys(best, 0.0)
+        for category, payload in corpus:
+            start = time.perf_counter()
+            function(payload)
+            elapsed[category] = elapsed.get(category, 0.0) + time.perf_counter() - start
+        for category, seconds in elapsed.items():
+            best[category] = min(seconds, best.get(category, seconds))
+    return best
+
+
+def trace_corpus(corpus, target):
+    """
+    Handles the corpus once while tracing allocations. Returns for each
+    category the highest peak of traced memory while handling one of
+    its payloads and the total that was still allocated afterwards.
+    """
+    function = target()
+    peak = {}
+    kept = {}
+    gc.collect()
+    for category, payload in corpus:
+        tracemalloc.start()
+        try:
+            function(payload)
+            current, highest = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        peak[category] = max(highest, peak.get(category, 0))
+        kept[category] = kept.get(category, 0) + current
+    return peak, kept
+
+
+def bench_suite(args):
+    corpus = load_corpus(args.capture)
+    targets = [("parser", parse_target(args.engine)), ("actor", actor_target)]
+    results = []
+    for name, target in targets:
+        times = run_corpus(corpus, target, args.repeat)
+        peak, kept = trace_corpus(corpus, target)
+        for category in CATEGORIES:
+            payloads = [p for c, p in corpus if c == category]
+            if not payloads:
+                continue
+            size = sum(len(p) for p in payloads)
+            seconds = times[category]
+            results.append({
+                "target": name,
+                "category": category,
+                "messages": len(payloads),
+                "bytes": size,
+                "seconds": seconds,
+                "mb_per_s": size / seconds / 1e6,
+                "messages_per_s": len(payloads) / seconds,
+                "peak_bytes": peak[category],
+                "retained_bytes": kept[category],
+            })
+
+    if args.json:
+        print(json.dumps(results, indent=1))
+        return
+    print("%-7s %-14s %6s %9s %9s %10s %10s %10s" % (
+        "target", "category", "msgs", "MB", "MB/s", "msgs/s", "peak KB", "kept KB"))
+    for r in results:
+        print("%-7s %-14s %6d %9.3f %9.2f %10.0f %10.1f %10.1f" % (
+            r["target"], r["category"], r["messages"], r["bytes"] / 1e6,
+            r["mb_per_s"], r["messages_per_s"], r["peak_bytes"] / 1e3,
+            r["retained_bytes"] / 1e3))
+
+
+if __name__ == "__main__":
+    arg = argparse.ArgumentParser()
+    arg.add_argument("-c", "--capture",
+                     help="capture to take payloads from, for example log/wesbot_rec.cap")
+    arg.add_argument("-r", "--repeat", type=int, default=5,
+                     help="number of runs, the fastest one is reported")
+    sub = arg.add_subparsers(dest="benchmark")
+    sub.required = True
+    sub.add_parser("lookup", help="attribute lookups on the initial gamelist") \
+        .set_defaults(run=bench_lookup)
+    memory = sub.add_parser("memory", help="memory held by the parsed initial gamelist")
+    memory.add_argument("-e", "--engine", choices=wmlparser.ENGINES, default="lines",
+                        help="engine the parser uses")
+    memory.set_defaults(run=bench_memory)
+    sub.add_parser("engines", help="parser throughput of each engine") \
+        .set_defaults(run=bench_engines)
+    sub.add_parser("send", help="messages per second through the outgoing frame encoder") \
+        .set_defaults(run=bench_send)
+    suite = sub.add_parser("suite", help="throughput and memory of the parser and "
+                                         "the Actor on each kind of payload")
+    suite.add_argument("-e", "--engine", choices=wmlparser.ENGINES, default="lines",
+                       help="engine the parser target uses")
+    suite.add_argument("--json", action="store_true",
+                       help="print the results as JSON, to keep for comparing later")
+    suite.set_defaults(run=bench_suite)
+    args = arg.parse_args()
+    args.run(args)
@@ -1,8 +1,13 @@
 #!/usr/bin/python3.6
+import asyncio
 import logging
 import logging.handlers
 import sys
 import os
+import random
+import time
+import typing
+from typing import List
 
 from rewritebotCFG import WesSettings
 from rewritebotCMD import CommandHandler
@@ -11,6 +16,9 @@ from rewritebotCON import WesSock
 from rewritebotACT import Actor
 from rewritebotSCHEMA import *
 
+# asyncio.current_task is Python 3.7, Task.current_task was removed in 3.9
+currentTask = getattr(asyncio, "current_task", None) or asyncio.Task.current_task
+
 
 def getLogger(filename: str, name: str) -> 'Logger':
     log = logging.getLogger(name)
@@ -21,91 +29,322 @@ def getLogger(filename: str, name: str) -> 'Logger':
     fh.setFormatter(formatter)
     log.setLevel(logging.DEBUG)
     if log.hasHandlers():
+        for handler in log.handlers:
+            handler.close()
         log.handlers.clear()
     log.addHandler(fh)
     return log
 
 
-class WesBot:
+class SessionSettings:
+    """
+    WesSettings with some values replaced for one session, for example
+    {"name": "1.16", "wesPort": 15016, "wesnothVersion": "1.16.0"}.
+    """
+
+    def __init__(self, cfg, overrides: dict):
+        self.__dict__.update(overrides)
+        self.base = cfg
+
+    def __getattr__(self, name):
+        return getattr(self.base, name)
+
+
+class WesSession:
+    """
+    One lobby connection of the bot, with its own WesSock, LobbyHolder,
+    Actor, stats and logs. All sessions share the bot's IRC connection,
+    CommandHandler and event loop. To the WesSock, Actor and lobby the
+    session is their main.
+    """
     lobby: LobbyHolder
-    cfg: WesSettings
-    irc: WesIrc
-    commandHandler: CommandHandler
     wesSock: WesSock
     actor: Actor
+    # The actions of a WesException that the session handles itself, see stop
+    ACTIONS = {WesException.QUIT_WES, WesException.RECONNECT_WES, WesException.ASSERT}
+
+    def __init__(self, bot: 'WesBot', name: str, cfg, fileSuffix=""):
+        self.bot = bot
+        self.name = name
+        self.cfg = cfg
+        self.enabled = True
+        self.wesSock = None
+        # The task connecting the session, see scheduleConnect
+        self.connecting = None
+        # Appended to the names of the session's log files, empty for the first session
+        self.fileSuffix = fileSuffix
+        self.connectedAt = None
+        # Kept over reconnects: the resolved address of the server connected to, and
+        # (host, port) if the server sent the bot on from the configured one
+        self.address = None
+        self.redirect = None
+        # For reconnecting, see scheduleReconnect
+        self.failures = 0
+        self.retryAt = 0
+        self.disconnectedAt = None
+        self.reconnects = 0
+        self.lastDowntime = 0
+        self.lastConnectDuration = 0
+        self.log = bot.log
+        self.userLog = getLogger("users" + fileSuffix, "users" + fileSuffix)
+        self.gameLog = getLogger("games" + fileSuffix, "games" + fileSuffix)
+        self.messageLog = getLogger("messages" + fileSuffix, "messages" + fileSuffix)
+        # For the WesSock, which is created again for every connect
+        self.sentLog = getLogger("wesbot_sent" + fileSuffix, "CON sent" + fileSuffix)
+        self.lobby = LobbyHolder(self, getLogger("stats" + fileSuffix, "stats" + fileSuffix),
+                                 "user_events" + fileSuffix)
+        self.actor = Actor(self)
+
+    @property
+    def commandHandler(self) -> CommandHandler:
+        return self.bot.commandHandler
+
+    @property
+    def stopped(self):
+        return self.bot.stopped
+
+    def scheduleConnect(self, loop: asyncio.AbstractEventLoop):
+        """
+        Connects the session when retryAt has come, see scheduleReconnect,
+        and lets loop service it.
+        """
+        # Called from the task itself when its attempt failed
+        if self.connecting is None or self.connecting is currentTask(loop):
+            self.connecting = loop.create_task(self.attach(loop))
+
+    async def attach(self, loop: asyncio.AbstractEventLoop):
+        try:
+            await asyncio.sleep(max(self.retryAt - time.time(), 0))
+            await self.connect(loop)
+        except Exception as e:
+            self.stop(e)
+        finally:
+            # Unless stop has scheduled the next attempt
+            if self.connecting is currentTask(loop):
+                self.connecting = None
+
+    async def connect(self, loop: asyncio.AbstractEventLoop):
+        """
+        Connects and logs in, the blocking parts in an executor thread so
+        that loop goes on serving IRC and the other sessions meanwhile.
+        The session gets its wesSock once it has joined the lobby and the
+        transport has the socket.
+        """
+        cfg = self.cfg
+        started = time.monotonic()
+        host, port = self.redirect or (cfg.serverName, cfg.wesPort)
+        self.log.info("connecting session %s to %s:%s", self.name, host, port)
+        wes = WesSock(self, cfg.wesnothVersion)
+        try:
+            try:
+                await loop.run_in_executor(None, wes.connect, host, port, self.address)
+            except (OSError, WesException):
+                if self.address is None:
+                    raise
+                # The server may have moved, start again from the configured one
+                self.log.warning("could not connect to %s:%s, resolving %s again", host, port, cfg.serverName)
+                self.address = self.redirect = None
+                wes.shutdown()
+                wes = WesSock(self, cfg.wesnothVersion)
+                await loop.run_in_executor(None, wes.connect, cfg.serverName, cfg.wesPort)
+            self.address = wes.address
+            if (wes.host, wes.port) != (cfg.serverName, cfg.wesPort):
+                self.redirect = (wes.host, wes.port)
+            await loop.run_in_executor(None, self.login, wes)
+            # The messages that come after joining the lobby are read by the loop from now on
+            await wes.attach(loop)
+        except Exception as e:
+            wes.shutdown()
+            if isinstance(e, OSError):
+                raise WesException("could not connect session {}: {}".format(self.name, e)).reconnectWes()
+            raise
+        # Only now, so that nothing is sent on the socket before the transport has it
+        self.wesSock = wes
+        # Those read with the login or while attaching
+        wes.actOnFrames()
+        self.lobby.stats.addConnectTime()
+        self.connectedAt = time.time()
+        if self.disconnectedAt is not None:
+            self.reconnects += 1
+            self.lastDowntime = self.connectedAt - self.disconnectedAt
+            self.lastConnectDuration = time.monotonic() - started
+            self.disconnectedAt = None
+            self.log.info("session %s reconnected after %.1f s, connecting took %.0f ms", self.name,
+                          self.lastDowntime, self.lastConnectDuration * 1000)
+
+    def login(self, wes: WesSock):
+        reconnect_attempts = 3
+        for i in range(reconnect_attempts):
+            if wes.loginLobby(self.cfg.username, self.cfg.password):
+                self.log.info("Managed to join lobby")
+                break
+            else:
+                self.log.warning("Failed to join lobby, trying again")
+            if i == reconnect_attempts - 1:
+                raise WesException("Did not manage to join lobby").addAction(WesException.FATAL)
+
+    def scheduleReconnect(self):
+        """
+        Sets when to connect again after losing the connection: at once,
+        then after wesReconnectDelay, doubling while the connections do
+        not last, up to wesReconnectMaxDelay. The waits are jittered so
+        that bots dropped together do not all come back at the same time.
+        """
+        cfg = self.cfg
+        now = time.time()
+        if self.connectedAt is not None and now - self.connectedAt > cfg.wesReconnectMaxDelay:
+            self.failures = 0
+        if self.disconnectedAt is None:
+            self.disconnectedAt = now
+        delay = 0
+        if self.failures > 0:
+            delay = min(cfg.wesReconnectDelay * 2 ** (self.failures - 1), cfg.wesReconnectMaxDelay)
+            delay *= random.uniform(0.5, 1)
+        self.failures += 1
+        self.retryAt = now + delay
+        self.log.info("session %s reconnects in %.1f s", self.name, delay)
+
+    def tick(self):
+        self.runGuarded(self.lobby.stats.tick)
+        # Which may have stopped the session
+        if self.wesSock is not None:
+            self.runGuarded(self.wesSock.scheduler.flush)
+
+    def runGuarded(self, function, *args):
+        """
+        Like WesBot.runGuarded, the exception is marked as this session's.
+        """
+        try:
+            function(*args)
+        except Exception as e:
+            self.stop(e)
+
+    def stop(self, e: Exception):
+        """
+        Disconnects the session for its Wesnoth errors, and reconnects it if
+        they ask for that, while the loop goes on serving the others. Other
+        errors stop mainLoop, see WesBot.stop.
+        """
+        e.session = self
+        actions = set(getattr(e, "action", ()))
+        if isinstance(e, WesException) and actions <= WesSession.ACTIONS and \
+                actions & {WesException.QUIT_WES, WesException.RECONNECT_WES}:
+            self.log.error("session %s: %s", self.name, e, exc_info=e)
+            self.disconnect(WesException.RECONNECT_WES in actions)
+        else:
+            self.bot.stop(e)
+
+    def disconnect(self, reconnect: bool):
+        """
+        Closes the connection, and connects again (RECONNECT_WES) or
+        disables the session (QUIT_WES).
+        """
+        if reconnect:
+            self.scheduleReconnect()
+        self.cleanup()
+        self.enabled = reconnect
+        self.bot.cfg.wesEnabled = any(session.enabled for session in self.bot.sessions)
+        if reconnect and self.bot.loop and self.bot.loop.is_running():
+            self.scheduleConnect(self.bot.loop)
+
+    def cleanup(self) -> typing.Optional[asyncio.Future]:
+        """
+        Closes the connection, returns what WesSock.shutdown does.
+        """
+        # TODO save stats
+        self.lobby.reset()
+        closing = None
+        if self.wesSock:
+            closing = self.wesSock.shutdown()
+            self.wesSock = None
+            self.connectedAt = None
+        return closing
 
-    userLog: 'Logger' = getLogger("users", "users")
-    gameLog: 'Logger' = getLogger("games", "games")
-    messageLog: 'Logger' = getLogger("messages", "messages")
+    def getStats(self):
+        wes = self.wesSock
+        if wes is None or self.connectedAt is None:
+            if not self.enabled or self.disconnectedAt is None:
+                return "{}: not connected".format(self.name)
+            return "{}: disconnected {:.0f} s ago, attempt {} in {:.0f} s".format(
+                self.name, time.time() - self.disconnectedAt, self.failures, max(self.retryAt - time.time(), 0))
+        seconds = max(time.time() - self.connectedAt, 1)
+        return "{} ({}:{}): received {} messages ({:.1f}/s, {:.1f} KB/s), sent {} ({:.1f}/s), {}".format(
+            self.name, self.cfg.serverName, self.cfg.wesPort, wes.receivedMessages, wes.receivedMessages / seconds,
+            wes.receivedBytes / seconds / 1000, wes.sentMessages, wes.sentMessages / seconds,
+            wes.scheduler.getStats()) + self.getReconnectStats()
+
+    def getReconnectStats(self):
+        if not self.reconnects:
+            return ""
+        return ", reconnected {} times, last after {:.1f} s down, connecting took {:.0f} ms".format(
+            self.reconnects, self.lastDowntime, self.lastConnectDuration * 1000)
+
+
+class WesBot:
+    cfg: WesSettings
+    irc: WesIrc
+    commandHandler: CommandHandler
+    sessions: List[WesSession]
 
     def __init__(self):
         self.cfg = WesSettings
-        self.wesSock = None
         self.irc = None
         self.signal_actions = set()
-        # TODO gameholder+userholder to lobbyholder to see who is in what game
-        # self.games: GameHolder = GameHolder(self)
-        # self.users = UserHolder(self)
-        self.lobby = LobbyHolder(self, getLogger("stats", "stats"))
+        # Kept with the connections attached to it between the runs of mainLoop
+        self.loop = None
+        # Set by mainLoop, done when it should return
+        self.stopped = None
+        self.ticker = None
         self.log = getLogger("general", "general")
         self.commandHandler = CommandHandler(self, self.cfg.botMasterNames[:], self.cfg.botIrcMasterNames[:])
-        self.actor = Actor(self)
-
-    def handleWesResponse(self) -> bool:  # whether there was a response
-        response = self.wesSock.receive_string()
-        if len(response) == 0:
-            return False
-        self.actor.actOnWML(self.actor.parseWML(response))
-        return True
+        # The first session uses the settings as they are, the others replace some of them
+        self.sessions = [WesSession(self, "main", self.cfg)]
+        for overrides in self.cfg.wesSessions:
+            name = overrides["name"]
+            self.sessions.append(WesSession(self, name, SessionSettings(self.cfg, overrides), "-" + name))
 
     def main(self):
+        """
+        Runs mainLoop again after each error that stops it, until an
+        action quits or restarts the bot.
+        """
         cfg = self.cfg
-        self.quitIfDisabled()
-        try:
-            if cfg.ircEnabled and not self.irc:
-                self.log.info("irc is enabled")
-                self.irc = WesIrc(self)
-                self.irc.connect()
-            if cfg.wesEnabled and not self.wesSock:
-                self.log.info("wes is enabled")
-                self.wesSock = WesSock(self, cfg.wesnothVersion)
-                self.wesSock.connect(cfg.serverName)
-                reconnect_attempts = 3
-                for i in range(reconnect_attempts):
-                    if self.wesSock.loginLobby(cfg.username, cfg.password):
-                        self.log.info("Managed to join lobby")
-                        self.handleWesResponse()
-                        break
-                    else:
-                        self.log.warning("Failed to join lobby, trying again")
-                    if i == reconnect_attempts - 1:
-                        raise WesException("Did not manage to join lobby").addAction(WesException.FATAL)
-                self.lobby.stats.addConnectTime()
-            self.mainLoop()
-        except WesException as e:
-            self.log.debug("actions %s", e.action)
-            for act in e.action:
-                if act == WesException.RESTART:
-                    self.signal_actions.add(WesException.QUIT)
-                elif act == WesException.FATAL:
-                    self.signal_actions.add(WesException.QUIT)
-                    self.log.error("Fatal error")
-                elif act == WesException.ASSERT:
-                    self.log.error("Assertion failed")
-                self.signal_actions.add(act)
-
-            self.log.exception(e)
-        except Exception as e:
-            self.log.error("generic error")
-            self.log.exception(e)
-            self.signal_actions.add(WesException.QUIT)
-        finally:
+        while True:
+            self.signal_actions.clear()
+            self.quitIfDisabled()
+            failed = None
+            try:
+                if cfg.ircEnabled and not self.irc:
+                    self.log.info("irc is enabled")
+                    self.irc = WesIrc(self)
+                    self.irc.connect()
+                self.mainLoop()
+            except WesException as e:
+                failed = getattr(e, "session", None)
+                self.log.debug("actions %s", e.action)
+                for act in e.action:
+                    if act == WesException.RESTART:
+                        self.signal_actions.add(WesException.QUIT)
+                    elif act == WesException.FATAL:
+                        self.signal_actions.add(WesException.QUIT)
+                        self.log.error("Fatal error")
+                    elif act == WesException.ASSERT:
+                        self.log.error("Assertion failed")
+                    self.signal_actions.add(act)
+
+                self.log.exception(e)
+            except Exception as e:
+                self.log.error("generic error")
+                self.log.exception(e)
+                self.signal_actions.add(WesException.QUIT)
+            # Wesnoth actions apply to the session they came from, or else to all
+            sessions = [failed] if failed else self.sessions
             if WesException.QUIT_IRC in self.signal_actions:
                 self.cleanupIrc()
                 cfg.ircEnabled = False
-            if WesException.QUIT_WES in self.signal_actions:
-                self.cleanupWes()
-                cfg.wesEnabled = False
+            if WesException.QUIT_WES in self.signal_actions or WesException.RECONNECT_WES in self.signal_actions:
+                for session in sessions:
+                    session.disconnect(WesException.RECONNECT_WES in self.signal_actions)
             if WesException.RESTART in self.signal_actions:
                 # os.execv(__file__, sys.argv)
                 # os.execl(sys.executable,sys.executable,* sys.argv)
@@ -117,30 +356,62 @@ class WesBot:
             if WesException.RECONNECT_IRC in self.signal_actions:
                 self.cleanupIrc()
                 cfg.ircEnabled = True
-            if WesException.RECONNECT_WES in self.signal_actions:
-                self.cleanupWes()
-                cfg.wesEnabled = True
-
-            # Since we did not restart or quit, go back to mainloop
-            self.main()
 
     def mainLoop(self):
-        cfg = self.cfg
+        """
+        Services the connections as data arrives on them, until a
+        WesException (or any other) stops it, which is then raised here.
+        A session's own Wesnoth errors do not stop it, the session
+        reconnects while the others go on, see WesSession.stop.
+        """
         self.commandHandler.init()
-        while True:
-            if cfg.ircEnabled:
-                irc_response = self.irc.receive()
-                irc_parts = irc_response.split(" ", 3)  # TODO might break when multiple commands are in same packet
-                if len(irc_parts) > 2 and irc_parts[1] == "PRIVMSG":
-                    self.commandHandler.onIrcMessage(irc_response.strip())
-            if cfg.wesEnabled:
-                for i in range(16):
-                    hadResponse = self.handleWesResponse()
-                    if not hadResponse:
-                        break
-                self.lobby.stats.tick()
-                self.commandHandler.tick()
-            self.quitIfDisabled()
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.serve(self.loop))
+
+    async def serve(self, loop: asyncio.AbstractEventLoop):
+        cfg = self.cfg
+        self.stopped = loop.create_future()
+        if cfg.ircEnabled and self.irc.transport is None:
+            await self.irc.attach(loop)
+        for session in self.sessions:
+            if session.wesSock and session.wesSock.transport is None and not session.connecting:
+                await session.wesSock.attach(loop)
+                session.wesSock.actOnFrames()
+            elif not session.wesSock and session.enabled and cfg.wesEnabled:
+                session.scheduleConnect(loop)
+        self.ticker = loop.call_soon(self.tick, loop)
+        try:
+            await self.stopped
+        finally:
+            self.ticker.cancel()
+
+    def tick(self, loop: asyncio.AbstractEventLoop):
+        cfg = self.cfg
+        if cfg.ircEnabled:
+            self.runGuarded(self.irc.ensure_connected)
+            self.runGuarded(self.irc.queue.flush)
+        if cfg.wesEnabled:
+            for session in self.sessions:
+                if session.wesSock:
+                    session.tick()
+            self.runGuarded(self.commandHandler.tick)
+        self.runGuarded(self.quitIfDisabled)
+        if not self.stopped.done():
+            self.ticker = loop.call_later(1, self.tick, loop)
+
+    def runGuarded(self, function, *args):
+        """
+        Calls function from the event loop, an exception stops mainLoop.
+        """
+        try:
+            function(*args)
+        except Exception as e:
+            self.stop(e)
+
+    def stop(self, e: Exception):
+        if not self.stopped.done():
+            self.stopped.set_exception(e)
 
     def quitIfDisabled(self):
         cfg = self.cfg
@@ -149,21 +420,23 @@ class WesBot:
             raise WesException().quit()
 
     def cleanup(self):
-        self.cleanupWes()
+        self.waitClosed([session.cleanup() for session in self.sessions])
         self.cleanupIrc()
 
-    def cleanupWes(self):
-        # TODO save stats
-        self.lobby.reset()
-        if self.wesSock:
-            self.wesSock.shutdown()
-            self.wesSock = None
-
     def cleanupIrc(self):
         if self.irc:
-            self.irc.shutdown()
+            self.waitClosed([self.irc.shutdown()])
             self.irc = None
 
+    def waitClosed(self, closing: List[typing.Optional[asyncio.Future]]):
+        """
+        Lets the transports being closed send what they have, see
+        WesSock.shutdown, unless the loop is running and does that anyway.
+        """
+        closing = [future for future in closing if future]
+        if closing and not self.loop.is_running():
+            self.loop.run_until_complete(asyncio.wait(closing, timeout=WesSock.socketTimeout))
+
 
 if __name__ == "__main__":
     WesBot().main()
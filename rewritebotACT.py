@@ -4,7 +4,7 @@ import wmlparser
 import typing
 
 if typing.TYPE_CHECKING:
-    from rewritebot import WesBot
+    from rewritebot import WesSession
 from rewritebotSCHEMA import User, Game, WesException
 
 # TODO handle b'[message]\nmessage="Can\'t find \'Ravana\'."\nsender="server"\n[/message]\n'        about ping
@@ -13,120 +13,55 @@ from rewritebotSCHEMA import User, Game, WesException
 # https://wiki.wesnoth.org/MultiplayerServerWML
 
 class Actor:
-    def __init__(self, main: 'WesBot'):
+    def __init__(self, main: 'WesSession'):
         self.log_cutoff_len = 500
         self.main = main
         self.cmd = main.commandHandler
-        self.parser = wmlparser.Parser(None)
-
-    def parseWML(self, s):
-        if len(s) == 0:
-            return s
-        wml = self.parser.parse_text(s)
-        # if len(s) < self.log_cutoff_len:
-        #     self.main.log.debug("WML %s", wml.debug())
-        return wml
-
-    def actOnWML(self, wml, path=None):
-        if path is None:
-            path = []
-        if (type(wml) is wmlparser.TagNode) or (type(wml) is wmlparser.RootNode):
-            attr: List[wmlparser.AttributeNode] = []
-            attrPath = path[:]
-            for node in wml.get_all():
-                if type(node) is wmlparser.AttributeNode:
-                    attr.append(node)
-                else:
-                    self.main.log.log(2, "got node %s", node.get_name())
-                    if node.get_name() == "gamelist_diff":
-                        self.actOnGamelistDiff(node)
-                    elif node.get_name() == "user":
-                        self.actOnUser(node)
-                    elif node.get_name() == "gamelist":
-                        self.actOnGamelist(node)
-                    elif node.get_name() == "whisper":
-                        self.actOnWhisper(node)
-                    elif node.get_name() == "message":
-                        # TODO only use relevant messages, not those in scenario code
-                        self.actOnMessage(node)
-                    elif node.get_name() == "speak":
-                        self.actOnSpeak(node)
-                    elif node.get_name() == "error":
-                        self.actOnError(node)
-                    elif node.get_name() == "observer":
-                        self.actOnObserver(node)
-                    elif node.get_name() == "observer_quit":
-                        self.actOnObserverQuit(node)
-                    else:
-                        for sub in node.get_all():
-                            self.actOnWML(sub, path + [node.get_name()])
-            self.parseAttr(attr, attrPath)
-        elif type(wml) is list:
-            raise WesException("actOnWML got wml as list")
-            # attr = []
-            # attrPath = path[:]
-            # tags = []
-            # for node in wml:
-            #     if type(node) is wmlparser.AttributeNode:
-            #         attr.append(node)
-            #     else:
-            #         tags.append(node)
-            # self.parseAttr(attr, attrPath)
-            # for node in tags:
-            #     self.actOnWML(node.get_all(), path + [node.get_name()])
-        elif type(wml) is wmlparser.AttributeNode:
-            self.main.log.log(2, "AttributeNode @%s %s %s", path, wml.get_name(), wml.get_text())
+        # Only tags at these paths are built and acted on, everything else
+        # (scenario, era, events, sides, ...) is skipped by the parser
+        self.dispatcher = wmlparser.TagDispatcher()
+        self.dispatcher.register("gamelist_diff", self.actOnGamelistDiff)
+        self.dispatcher.register("user", self.actOnUser)
+        self.dispatcher.register("gamelist", self.actOnGamelist)
+        self.dispatcher.register("whisper", self.actOnWhisper)
+        self.dispatcher.register("message", self.actOnMessage)
+        self.dispatcher.register("*/command/speak", self.actOnSpeak)
+        self.dispatcher.register("error", self.actOnError)
+        self.dispatcher.register("observer", self.actOnObserver)
+        self.dispatcher.register("observer_quit", self.actOnObserverQuit)
+        self.dispatcher.on_attribute = self.parseAttr
+        # The PushParser of the message being received
+        self.parser = None
+
+    def actOnData(self, data):
+        if len(data) == 0:
+            return
+        if type(data) is str:
+            data = data.encode("utf8")
+        self.startData()
+        self.feedData(data)
+        self.endData()
+
+    # A message can also be given in parts, as they are received
+
+    def startData(self):
+        self.dispatcher.reset()
+        self.parser = wmlparser.PushParser(self.dispatcher)
+
+    def feedData(self, data: bytes):
+        self.parser.feed(data)
+
+    def endData(self):
+        parser = self.parser
+        self.parser = None
+        parser.close()
 
     def actOnGamelistDiff(self, node: wmlparser.TagNode):
         self.main.log.log(2, "in actOnGamelistDiff with %s", node.get_name())
-        usersToRemove = set()
-        usersToAdd = set()
-        for child in node.get_all(tag="delete_child"):
-            index = int(child.get_text_val("index"))
-            if len(child.get_all(tag="user")) == 1:
-                self.main.log.log(5, "user %s should be removed" % index)
-                usersToRemove.add(self.main.lobby.users.getI(index).name)
-
-        for child in node.get_all(tag="insert_child"):
-            index = int(child.get_text_val("index"))
-            self.main.log.log(3, "%s %s", child.get_name(), index)
-            for child in child.get_all(tag="user"):
-                u = User(child)
-                self.main.log.log(5, "user %s should be inserted to %s", u.name, index)
-                usersToAdd.add(u.name)
-                if u.name in usersToRemove:
-                    self.main.lobby.users.insertUser(u, index, None)
-                else:
-                    self.main.lobby.users.insertUser(u, index)
-            for child in child.get_all(tag="game"):
-                g = Game(child)
-                self.main.log.log(5, "game %s(%s) should be inserted to %s", g.name, g.id, index)
-                self.main.lobby.games.insertGame(g, index)
-
-        for child in node.get_all(tag="delete_child"):
-            index = int(child.get_text_val("index"))
-            self.main.log.log(3, "%s %s", child.get_name(), index)
-            if len(child.get_all(tag="user")) == 1:
-                self.main.log.log(5, "user %s should be removed" % index)
-                if self.main.lobby.users.getI(index).name in usersToAdd:
-                    self.main.lobby.users.deleteI(index, None)
-                else:
-                    self.main.lobby.users.deleteI(index)
-            elif len(child.get_all(tag="game")) == 1:
-                self.main.log.log(5, "game %s should be removed" % index)
-                self.main.lobby.games.removeGame(index)
-            else:
-                self.main.log.error("actOnGamelistDiff with %s users and %s games",
-                                    len(child.get_all(tag="user")),
-                                    len(child.get_all(tag="game")))
-        for child in node.get_all(tag="change_child"):
-            if int(child.get_text_val("index")) != 0:
-                raise WesException("[gamelist_diff][change_child]index={}, 0 expected"
-                                   .format(node.get_text_val("index")))
-            # This has subtags like delete_child, instead of initial uncondition addition
-            gamelists = child.get_all(tag="gamelist")
-            assert len(gamelists) == 1
-            self.actOnGamelistDiff(gamelists[0])
+        try:
+            wmlparser.apply_diff(LobbyDiff(self.main, node), node)
+        except wmlparser.WMLDiffError as e:
+            raise WesException("[gamelist_diff] {}".format(e)).addAction(WesException.ASSERT).quit()
 
     def actOnUser(self, node: wmlparser.TagNode):
         # self.main.log.error("actOnUser should not be called currently")  # it should, when first joining lobby
@@ -145,7 +80,7 @@ class Actor:
         self.main.log.log(2, "on gamelist")
         # self.main.log.debug("on gamelist %s", node.debug()[:self.log_cutoff_len])
         # save them to games
-        for game in node.get_all(tag="game"):
+        for game in node.select("game"):
             self.main.lobby.games.addInitialGame(Game(game))
 
     def actOnWhisper(self, node: wmlparser.TagNode):
@@ -154,7 +89,7 @@ class Actor:
         message = node.get_text_val("message")
         # self.main.log.debug("%s %s %s", sender, "~", message)
         whisper = True
-        self.cmd.onWesMessage(message, sender, self.main.lobby.users.isRegistered(sender), whisper)
+        self.cmd.onWesMessage(message, sender, self.main.lobby.users.isRegistered(sender), whisper, self.main)
 
     def actOnMessage(self, node: wmlparser.TagNode):
         # self.main.log.debug("on message %s", node.debug())
@@ -167,14 +102,14 @@ class Actor:
             self.main.log.error("sender or message is None in actOnMessage")
             return
         # self.main.log.debug("%s %s %s", sender, ">", message)
-        self.cmd.onWesMessage(message, sender, self.main.lobby.users.isRegistered(sender))
+        self.cmd.onWesMessage(message, sender, self.main.lobby.users.isRegistered(sender), False, self.main)
 
     def actOnSpeak(self, node: wmlparser.TagNode):
         self.main.log.debug("on speak %s", node.debug())
         sender = node.get_text_val("id")
         message = node.get_text_val("message")
         self.main.log.debug("%s %s %s", sender, ">", message)
-        self.cmd.onWesMessage(message, sender, self.main.lobby.users.isRegistered(sender))
+        self.cmd.onWesMessage(message, sender, self.main.lobby.users.isRegistered(sender), False, self.main)
 
     def actOnObserver(self, node: wmlparser.TagNode):
         self.main.log.debug("on observer %s", node.debug())
@@ -185,17 +120,115 @@ class Actor:
     def actOnError(self, node: wmlparser.TagNode):
         self.main.log.warn("on error %s", node.debug())
 
-    def parseAttr(self, attr: List[wmlparser.AttributeNode], path: List[str]):
-        if len(attr) < 1:
+    def parseAttr(self, attr: wmlparser.AttributeNode, path: List[bytes]):
+        # TODO test if ping is used anymore, since seems that not
+        # if attr.get_name() == "ping":
+        #     return
+        self.main.log.log(2, "Attr @%s %s=%s", path, attr.get_name(), attr.get_text())
+
+
+class LobbyDiff(wmlparser.DiffTarget):
+    """
+    Applies a [gamelist_diff] to the lobby: [user] children of the root
+    and, through GamelistDiff, the [game] children of its [gamelist].
+    """
+
+    def __init__(self, main: 'WesSession', diff: wmlparser.TagNode):
+        self.main = main
+        self.users = main.lobby.users
+        # A user that is deleted and inserted again by the same diff has
+        # only changed, this is not counted as leaving and joining
+        self.usersToRemove = set()
+        self.usersToAdd = set()
+        for child in diff.select("delete_child"):
+            index = wmlparser.diff_index(child)
+            if child.first("user") is not None:
+                self.main.log.log(5, "user %s should be removed" % index)
+                self.usersToRemove.add(self.users.getI(index).name)
+
+    def child(self, name: bytes, index: int):
+        if name == b"gamelist":
+            if index != 0:
+                raise WesException("[gamelist_diff][change_child]index={}, 0 expected".format(index))
+            return GamelistDiff(self.main)
+        if name == b"user":
+            return ObjectDiff(self.users.getI(index))
+        return wmlparser.DiffTarget()
+
+    def insert_child(self, name: bytes, index: int, node: wmlparser.TagNode):
+        self.main.log.log(3, "insert_child %s %s", name, index)
+        if name != b"user":
+            self.main.log.error("actOnGamelistDiff insert_child with [%s]", name.decode("utf8"))
             return
-        if (len(path) > 0 and (
-                path[0] == "era" or path[0] == "music" or
-                path[0] == "time" or path[0] == "multiplayer" or path[0] == "event" or path[0] == "side")):
+        u = User(node)
+        self.main.log.log(5, "user %s should be inserted to %s", u.name, index)
+        self.usersToAdd.add(u.name)
+        if u.name in self.usersToRemove:
+            self.users.insertUser(u, index, None)
+        else:
+            self.users.insertUser(u, index)
+
+    def delete_child(self, name: bytes, index: int):
+        self.main.log.log(3, "delete_child %s %s", name, index)
+        if name != b"user":
+            self.main.log.error("actOnGamelistDiff delete_child with [%s]", name.decode("utf8"))
             return
-        # input()
-        # print("parsing attr")
-        for a in attr:
-            # TODO test if ping is used anymore, since seems that not
-            # if a.get_name() == "ping":
-            #     continue
-            self.main.log.log(2, "Attr @%s %s=%s", path, a.get_name(), a.get_text())
+        self.main.log.log(5, "user %s should be removed" % index)
+        if self.users.getI(index).name in self.usersToAdd:
+            self.users.deleteI(index, None)
+        else:
+            self.users.deleteI(index)
+
+
+class GamelistDiff(wmlparser.DiffTarget):
+    """
+    The [gamelist] part of a [gamelist_diff], changing the lobby's games.
+    """
+
+    def __init__(self, main: 'WesSession'):
+        self.main = main
+        self.games = main.lobby.games
+
+    def child(self, name: bytes, index: int):
+        if name == b"game":
+            return ObjectDiff(self.games.getI(index))
+        return wmlparser.DiffTarget()
+
+    def insert_child(self, name: bytes, index: int, node: wmlparser.TagNode):
+        if name != b"game":
+            self.main.log.error("actOnGamelistDiff [gamelist] insert_child with [%s]", name.decode("utf8"))
+            return
+        g = Game(node)
+        self.main.log.log(5, "game %s(%s) should be inserted to %s", g.name, g.id, index)
+        self.games.insertGame(g, index)
+
+    def delete_child(self, name: bytes, index: int):
+        if name != b"game":
+            self.main.log.error("actOnGamelistDiff [gamelist] delete_child with [%s]", name.decode("utf8"))
+            return
+        self.main.log.log(5, "game %s should be removed" % index)
+        self.games.removeGame(index)
+
+
+class ObjectDiff(wmlparser.DiffTarget):
+    """
+    A [change_child] of a single user or game, whose changed attributes
+    are passed on to its setAttribute. Attributes of the first subtag
+    of a name are passed with its path, like "slot_data/vacant".
+    """
+
+    def __init__(self, obj, prefix=""):
+        self.obj = obj
+        # The path of a subtag, like "slot_data/"
+        self.prefix = prefix
+
+    def set_attribute(self, attribute: wmlparser.AttributeNode):
+        self.obj.setAttribute(self.prefix + attribute.get_name(), attribute.get_text())
+
+    def delete_attribute(self, name: bytes):
+        self.obj.setAttribute(self.prefix + name.decode("utf8"), None)
+
+    def child(self, name: bytes, index: int):
+        if index != 0:
+            return wmlparser.DiffTarget()
+        return ObjectDiff(self.obj, self.prefix + name.decode("utf8") + "/")
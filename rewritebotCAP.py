@@ -0,0 +1,182 @@
+import gzip
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import typing
+
+# Starts every capture file
+MAGIC = b"WESCAP1\n"
+# Before every frame: when it was received (seconds since the epoch) and its length
+RECORD = struct.Struct(">dI")
+
+log = logging.getLogger("CAP")
+
+
+class CaptureWriter:
+    """
+    Writes the frames received from the server, still gzipped as they
+    were sent, to a capture file. Each is stored with the time it was
+    received, see readCapture. The file is written by a thread of its
+    own, so capturing a frame only puts it into a queue; if the queue
+    is full, the frame is dropped instead. When the file would grow
+    past maxBytes it is renamed to path.1 (path.1 to path.2, ...)
+    and a new one started, keeping backupCount old files.
+
+    Frames can be sampled (only that fraction of them is written), and
+    capturing can be turned off and on while running. An error writing
+    the file ends capturing, the thread goes on emptying the queue.
+    """
+
+    MAX_QUEUED = 1000
+
+    def __init__(self, path: str, maxBytes: int, backupCount: int, sample=1.0, enabled=True):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.sample = sample
+        self.enabled = enabled
+        # Fraction of a frame to be captured, grows by sample per frame
+        self.credit = 0.0
+        self.captured = 0
+        self.dropped = 0
+        self.written = 0
+        self.queue = queue.Queue(CaptureWriter.MAX_QUEUED)
+        self.thread = None
+        self.file = None
+        # Set by close if the queue had no room for the None that ends the thread
+        self.stopping = False
+        # What ended capturing, if writing failed
+        self.error = None
+
+    def wants(self) -> bool:
+        """
+        Tells whether the next frame should be captured.
+        """
+        if not self.enabled:
+            return False
+        self.credit += self.sample
+        if self.credit < 1:
+            return False
+        self.credit -= 1
+        return True
+
+    def write(self, frame: bytes):
+        if self.error is not None:
+            self.dropped += 1
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="capture", daemon=True)
+            self.thread.start()
+        try:
+            self.queue.put_nowait((time.time(), frame))
+            self.captured += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """
+        Lets the thread stop once it has written the queued frames. Does
+        not wait for that, see join.
+        """
+        if self.thread is not None:
+            try:
+                self.queue.put_nowait((0, None))
+            except queue.Full:
+                self.stopping = True
+
+    def join(self):
+        """
+        Waits until the thread has stopped after close, from a thread other
+        than the event loop's.
+        """
+        if self.thread is not None:
+            self.thread.join()
+
+    def getStats(self):
+        return "Capture {}: sample {}, captured {}, dropped {}, written {} bytes{}".format(
+            "on" if self.enabled else "off", self.sample, self.captured, self.dropped, self.written,
+            ", failed: {}".format(self.error) if self.error is not None else "")
+
+    def _run(self):
+        try:
+            while True:
+                received, frame = self.queue.get()
+                if frame is None:
+                    return
+                if self.error is None:
+                    try:
+                        self._write(received, frame)
+                    except Exception as e:
+                        self.error = e
+                        log.error("capturing to %s failed: %s", self.path, e)
+                        self._close()
+                if self.stopping and self.queue.empty():
+                    return
+        finally:
+            self._close()
+
+    def _write(self, received: float, frame: bytes):
+        if self.file is None:
+            self.file = self._open()
+        f = self.file
+        if f.tell() + RECORD.size + len(frame) > self.maxBytes and f.tell() > len(MAGIC):
+            self._close()
+            self._rotate()
+            f = self.file = self._open()
+        f.write(RECORD.pack(received, len(frame)))
+        f.write(frame)
+        self.written += RECORD.size + len(frame)
+        if self.queue.empty():
+            f.flush()
+
+    def _close(self):
+        f = self.file
+        self.file = None
+        if f is not None:
+            try:
+                f.close()
+            except OSError:
+                pass  # what could not be written is lost
+
+    def _open(self):
+        f = open(self.path, "ab")
+        if f.tell() == 0:
+            f.write(MAGIC)
+        return f
+
+    def _rotate(self):
+        for i in range(self.backupCount - 1, 0, -1):
+            name = "{}.{}".format(self.path, i)
+            if os.path.exists(name):
+                os.replace(name, "{}.{}".format(self.path, i + 1))
+        if self.backupCount > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+
+
+def isCapture(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def readCapture(path: str) -> typing.Iterator[typing.Tuple[float, bytes]]:
+    """
+    Yields the time and the decompressed message of each frame in the
+    capture file at path. A frame cut short by the bot stopping ends it.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a capture file".format(path))
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            received, length = RECORD.unpack(header)
+            frame = f.read(length)
+            if len(frame) < length:
+                return
+            yield received, gzip.decompress(frame)
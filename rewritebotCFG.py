@@ -5,9 +5,26 @@ class WesSettings:
     username = "***"
     password = "***"
     wesnothVersion = "1.13.14"
+    wesGzipLevel = 6  # for sent messages, 1 (fastest) to 9 (smallest)
+    # Whispers and lobby messages sent in any wesSendWindow seconds. wesnothd allows 4 per 10 seconds, but
+    # counts them in whole seconds, so 5 messages less than 11 seconds apart can be too many
+    wesSendLimit = 4
+    wesSendWindow = 11
+    wesCaptureEnabled = True  # received messages are captured to log/wesbot_rec.cap
+    wesCaptureSample = 1.0  # fraction of them to capture
+    wesCaptureMaxBytes = 100 * 1024 * 1024
     serverName = "localhost"
     serverName = "server.wesnoth.org"
+    wesPort = 15000
+    # More lobbies to connect to, each a dict with a "name" and the settings it changes, like
+    # {"name": "1.16", "wesPort": 15016, "wesnothVersion": "1.16.0"}
+    wesSessions = []
+    # A lost connection is retried at once, then after wesReconnectDelay seconds, doubling up to wesReconnectMaxDelay
+    wesReconnectDelay = 2
+    wesReconnectMaxDelay = 300
     ircName = "***"
     ircPass = "***"
     ircNet = "irc.ca.us.mibbit.net"  # mibbit has limit of 3 connections per IP for each server, ca.us seems best for this
     ircChan = "#wesnoth-bot"
+    ircSendRate = 1  # lines per second to the channel and to users, long messages are split into several
+    ircSendBurst = 5
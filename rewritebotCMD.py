@@ -2,7 +2,6 @@ import datetime
 import logging
 import logging.handlers
 import random
-import re
 import subprocess
 from typing import Dict, Any, Callable
 
@@ -10,7 +9,8 @@ from rewritebotSCHEMA import WesException
 import typing
 
 if typing.TYPE_CHECKING:
-    from rewritebot import WesBot
+    from rewritebot import WesBot, WesSession
+    from rewritebotIRC import IrcMessage
 
 PERMISSION_ADMIN = 90
 PERMISSION_TRUSTED = 50
@@ -29,7 +29,9 @@ class Command:
 
 
 class CommandHandler:
-    pingUsers: Dict[str, typing.Tuple[int, datetime.datetime]]  # name -> (interval, last ping time)
+    # Commands that use the session's WesSock, answered with "not connected" while it has none
+    WES_COMMANDS = {"raw", "stats", "say", "m", "capture", "follow", "control", "leave"}
+    pingUsers: Dict[str, typing.Tuple[int, datetime.datetime, 'WesSession']]  # name -> (interval, last ping time, session)
     commands: Dict[str, Command]
 
     def __init__(self, main: 'WesBot', wesMasters, ircMasters):
@@ -39,8 +41,7 @@ class CommandHandler:
                             "Forum thread: https://forums.wesnoth.org/viewtopic.php?f=10&t=43965. " \
                             "Current prefix: " + self.prefix
         self.main = main
-        self.wes = main.wesSock  # TODO useless statement, wesSock is null at that time
-        self.irc = main.irc  # TODO useless statement, wesSock is null at that time
+        self.irc = main.irc  # TODO useless statement, irc is null at that time
         self.wesMasters = wesMasters
         self.ircMasters = ircMasters
         self.log = logging.getLogger("CMD")
@@ -53,14 +54,18 @@ class CommandHandler:
         self.pingUsers = {}
 
     def init(self):
-        self.wes = self.main.wesSock
         self.irc = self.main.irc
 
-    def onIrcMessage(self, data):
-        self.log.debug("with unparsed irc message in commandhandler %s", data)
-        # message = data.split('#',1)[1].split(":",1)[1].strip("\r\n")
-        message = data.split(":", 2)[2]
-        sender = data[1:].split("!", 1)[0]
+    def sessionOf(self, session: 'WesSession' = None) -> 'WesSession':
+        """
+        The session a message came from, or the first one for IRC.
+        """
+        return session or self.main.sessions[0]
+
+    def onIrcMessage(self, data: 'IrcMessage'):
+        self.log.debug("with irc message in commandhandler %s", data.line)
+        message = data.params[-1]
+        sender = data.nick
         if sender == "IRC":
             if "Too many connections from your IP" in message:
                 net_ = self.main.cfg.ircNetAlt
@@ -69,7 +74,7 @@ class CommandHandler:
                     self.main.cfg.ircNet = random.choice(list(net_))
                     raise WesException().reconnectIrc()
             return  # Message from IRC network, not something that should be treated as user message
-        target = data.split(" ", 3)[2]
+        target = data.params[0]
         self.log.debug("target %s", target)
         whisper = "#" not in target
         self.log.debug("with irc message in commandhandler %s %s %s", sender, ">", message)
@@ -79,8 +84,9 @@ class CommandHandler:
 
         self.onMessage(message, sender, permission, "irc", whisper)
 
-    def onWesMessage(self, message, sender, registered=False, whisper=False):
-        cfg = self.main.cfg
+    def onWesMessage(self, message, sender, registered=False, whisper=False, session: 'WesSession' = None):
+        session = self.sessionOf(session)
+        cfg = session.cfg
         # possibly server does not use registrations
         self.log.log(6, "with wes message in commandhandler, sender=%s, message=%s, registered=%s, whisper=%s", sender,
                      message, registered, whisper)
@@ -94,14 +100,15 @@ class CommandHandler:
         elif registered:
             permission = PERMISSION_REGISTERED + 1
 
-        self.onMessage(message, sender, permission, "wes", whisper)
+        self.onMessage(message, sender, permission, "wes", whisper, session)
 
-    def onMessage(self, message: str, sender, permission, origin, private=False):
-        cfg = self.main.cfg
+    def onMessage(self, message: str, sender, permission, origin, private=False, session: 'WesSession' = None):
+        session = self.sessionOf(session)
+        cfg = session.cfg
         if private:
-            self.logOnIrc("<{}> -> <{}>: {}".format(sender, cfg.username, message))
+            self.logOnIrc("<{}> -> <{}>: {}".format(sender, cfg.username, message), session)
         elif origin == "wes":
-            self.main.messageLog.info("<%s> %s", sender, message)
+            session.messageLog.info("<%s> %s", sender, message)
 
         self.log.info("Received generic message with info: sender=%s, message=%s, permission=%s, type=%s, private=%s",
                       sender, message, permission, origin, private)
@@ -110,22 +117,25 @@ class CommandHandler:
             return
         if permission < PERMISSION_TRUSTED and not private:
             if cfg.username in message:
-                self.onCommand("help", sender, permission, origin)
+                self.onCommand("help", sender, permission, origin, session)
             return
         if message.startswith(self.prefix):
-            self.onCommand(message[len(self.prefix):], sender, permission, origin)
+            self.onCommand(message[len(self.prefix):], sender, permission, origin, session)
         elif message == "help" and private:
-            self.onCommand("help", sender, permission, origin)
+            self.onCommand("help", sender, permission, origin, session)
         elif cfg.username in message and private:
-            self.onCommand("help", sender, permission, origin)
+            self.onCommand("help", sender, permission, origin, session)
         elif private and permission < PERMISSION_TRUSTED:
             self.sendPrivately(
                 sender, origin, "Message not recognized. You are {} with permission {}. Try using {}help and {}commands".format(
-                    sender, permission, self.prefix, self.prefix))
+                    sender, permission, self.prefix, self.prefix), session=session)
+
+    def onCommand(self, message, sender, permission, origin, session: 'WesSession' = None):
+        session = self.sessionOf(session)
+        wes = session.wesSock
 
-    def onCommand(self, message, sender, permission, origin):
         def reply(message):
-            self.sendPrivately(sender, origin, str(message))
+            self.sendPrivately(sender, origin, str(message), permission > PERMISSION_ADMIN, session)
 
         if " " in message:
             message = message.split(" ", 1)
@@ -135,9 +145,14 @@ class CommandHandler:
             command = message
             args = ""
         self.log.debug("got command %s %s %s", command, "with args", args)
+        if wes is None and command in CommandHandler.WES_COMMANDS:
+            # Between a lost connection and the reconnect
+            reply("{} is not connected".format(session.name))
+            return
 
         if command in self.commands and permission > self.commands[command].permission:
-            self.commands[command].command(reply=reply, args=args, permission=permission, sender=sender)
+            self.commands[command].command(reply=reply, args=args, permission=permission, sender=sender,
+                                           session=session)
 
         if command == "join" and permission > PERMISSION_ADMIN:
             self.irc.join(args)
@@ -155,8 +170,8 @@ class CommandHandler:
             if not args or args == "":
                 args = sender
             try:
-                user = self.main.lobby.users.get(args)
-                self.wes.send_wml_string("[join]\nid={}\nobserve=yes\n[/join]".format(user.game_id))
+                user = session.lobby.users.get(args)
+                wes.send_tag("join", id=user.game_id, observe="yes")
             except WesException as e:
                 if e.action != [WesException.ASSERT]:
                     raise e
@@ -165,15 +180,11 @@ class CommandHandler:
             parts = args.split(" ", 1)
             if len(parts) == 2:
                 side, target = parts[0], parts[1]
-                self.wes.send_wml_string("""[change_controller]
-controller="human"
-player="%s"
-side="%s"
-[/change_controller]""" % (target, side))
+                wes.send_tag("change_controller", controller="human", player=target, side=side)
             else:
                 reply("control needs to have two arguments")
         elif command == "leave" and permission > PERMISSION_ADMIN:
-            self.wes.send_wml_string("[leave_game]\n[/leave_game]")
+            wes.send_tag("leave_game")
         elif command == "trust" and permission > PERMISSION_ADMIN:
             self.main.cfg.botTrustedNames.append(args.strip())
             reply("Added '{}' to trusted names. Current list: {}".format(args.strip(), self.main.cfg.botTrustedNames))
@@ -186,7 +197,7 @@ side="%s"
         def raw(**kwargs):
             try:
                 with open("raw.cfg", "r", encoding="utf8") as f:
-                    self.wes.send_wml_string("".join(f.readlines()))
+                    kwargs["session"].wesSock.send_wml_string("".join(f.readlines()))
             except Exception as e:
                 self.main.log.warning("raw failed", e)
 
@@ -195,23 +206,23 @@ side="%s"
 No arguments"""
             # TODO round times
             kwargs["reply"]("Time since first connect: {}, time since last connect: {}"
-                            .format(self.main.lobby.stats.getTimeSinceFirstConnect(),
-                                    self.main.lobby.stats.getTimeSinceLastConnect()))
+                            .format(kwargs["session"].lobby.stats.getTimeSinceFirstConnect(),
+                                    kwargs["session"].lobby.stats.getTimeSinceLastConnect()))
 
         def userstats(**kwargs):
             """Finds when and for how long user $1 has been online
 $1 = name of user to query"""
             # TODO round times
-            kwargs["reply"](self.main.lobby.stats.getUserStats(kwargs["args"]))
+            kwargs["reply"](kwargs["session"].lobby.stats.getUserStats(kwargs["args"]))
 
         def save(**kwargs):
             """Debug command to trigger writing user events to file"""
-            self.main.lobby.stats.saveUsers()
+            kwargs["session"].lobby.stats.saveUsers()
             kwargs["reply"]("Users saved")
 
         def gcUsers(**kwargs):
             """Debug command to delete user events of users not seen in last 10 min"""
-            self.main.lobby.stats.deleteOldData(datetime.datetime.now(), datetime.timedelta(minutes=10))
+            kwargs["session"].lobby.stats.deleteOldData(datetime.datetime.now(), datetime.timedelta(minutes=10))
             kwargs["reply"]("Users garbage collection done")
 
         def gitPull(**kwargs):
@@ -224,8 +235,14 @@ $1 = name of user to query"""
 
         def stats(**kwargs):
             """Command to get basic lobby statistics. Might not work correctly currently"""
-            kwargs["reply"]("Game stats: {}, User stats: {}".format(self.main.lobby.games.getStats(),
-                                                                    self.main.lobby.users.getStats()))
+            session = kwargs["session"]
+            kwargs["reply"]("Game stats: {}, User stats: {}, {}{}".format(
+                session.lobby.games.getStats(), session.lobby.users.getStats(), session.wesSock.scheduler.getStats(),
+                ", " + self.irc.queue.getStats() if self.irc else ""))
+
+        def sessions(**kwargs):
+            """Messages received and sent by each lobby connection"""
+            kwargs["reply"]("; ".join(session.getStats() for session in self.main.sessions))
 
         def say(**kwargs):
             """Say $1 publicly, usually in lobby. Doesnt seem to work from in game in 1.14
@@ -235,7 +252,7 @@ $1 = message"""
             if len(kwargs["args"]) == 0:
                 kwargs["reply"]("message is required")
             else:
-                self.sayOnWesnoth(kwargs["args"])
+                self.sayOnWesnoth(kwargs["args"], session=kwargs["session"])
 
         def m(**kwargs):
             """Send private message $2- to user $1. Trusted users can only message Trusted+ users.
@@ -249,7 +266,7 @@ $2- = message"""
             if kwargs["permission"] > PERMISSION_ADMIN \
                     or receiver in self.main.cfg.botTrustedNames \
                     or receiver in self.wesMasters:
-                self.sendPrivately(receiver, "wes", msg)
+                self.sendPrivately(receiver, "wes", msg, session=kwargs["session"])
             else:
                 kwargs["reply"]("Currently trusted users can only message to another trusted users and admins")
 
@@ -300,6 +317,24 @@ $2- = message"""
                                 .format(sorted(publicCommands), sorted(trustedCommands), sorted(adminCommands),
                                         self.prefix))
 
+        def capture(**kwargs):
+            """Turns capturing received messages off or on, or captures only fraction $1 of them
+[$1 = on, off or a number from 0 to 1]"""
+            writer = kwargs["session"].wesSock.capture
+            args = kwargs["args"].strip()
+            if args == "off":
+                writer.enabled = False
+            elif args == "on":
+                writer.enabled = True
+            elif args:
+                try:
+                    writer.sample = min(max(float(args), 0.0), 1.0)
+                    writer.enabled = True
+                except ValueError:
+                    kwargs["reply"]("Use on, off or a number from 0 to 1")
+                    return
+            kwargs["reply"](writer.getStats())
+
         def addPing(**kwargs):
             """Sender will be sent "ping" private message every $1 minutes
 $1 = number, default 1. Use <=1 to remove ping, example 0"""
@@ -312,17 +347,20 @@ $1 = number, default 1. Use <=1 to remove ping, example 0"""
                 del self.pingUsers[kwargs["sender"]]
                 kwargs["reply"]("You will not be pinged anymore")
             else:
-                self.pingUsers[kwargs["sender"]] = (interval, datetime.datetime.now())
+                self.pingUsers[kwargs["sender"]] = (interval, datetime.datetime.now(), kwargs["session"])
                 kwargs["reply"]("You will be pinged every {} minutes".format(interval))
 
         self.commands = {
             "raw": Command(PERMISSION_ADMIN, raw),
             "uptime": Command(PERMISSION_PUBLIC, uptime),
-            "users": Command(PERMISSION_PUBLIC, lambda **kwargs: kwargs["reply"](self.main.lobby.users.getUsers())),
-            "games": Command(PERMISSION_PUBLIC, lambda **kwargs: kwargs["reply"](self.main.lobby.games.getGames())),
+            "users": Command(PERMISSION_PUBLIC,
+                             lambda **kwargs: kwargs["reply"](kwargs["session"].lobby.users.getUsers())),
+            "games": Command(PERMISSION_PUBLIC,
+                             lambda **kwargs: kwargs["reply"](kwargs["session"].lobby.games.getGames())),
             "online": Command(PERMISSION_PUBLIC,
-                              lambda **kwargs: kwargs["reply"](self.main.lobby.users.getOnlineUsers())),
+                              lambda **kwargs: kwargs["reply"](kwargs["session"].lobby.users.getOnlineUsers())),
             "stats": Command(PERMISSION_PUBLIC, stats),
+            "sessions": Command(PERMISSION_PUBLIC, sessions),
             "help": Command(PERMISSION_PUBLIC, lambda **kwargs: kwargs["reply"](self.HELP_MESSAGE)),
             "ping": Command(PERMISSION_PUBLIC, addPing),
             "user": Command(PERMISSION_TRUSTED, userstats),
@@ -332,35 +370,46 @@ $1 = number, default 1. Use <=1 to remove ping, example 0"""
             "say": Command(PERMISSION_ADMIN, say),
             "m": Command(PERMISSION_TRUSTED, m),
             "alias": Command(PERMISSION_ADMIN, alias),
+            "capture": Command(PERMISSION_ADMIN, capture),
             "q": Command(PERMISSION_ADMIN, q),
             "restart": Command(PERMISSION_ADMIN, restart),
             "commands": Command(PERMISSION_PUBLIC, commandsHelp)
         }
 
-    def sayOnWesnoth(self, message, room=""):
+    def sayOnWesnoth(self, message, room="", priority=False, session: 'WesSession' = None):
+        session = self.sessionOf(session)
         if type(message) != type(""):
             message = repr(message)
-        self.logOnIrc("->{}: {}".format(room, message))
-        self.wes.send_wml_string(
-            '[message]\nmessage="' + re.sub('"', '""', message) + '"\nroom="' + room + '"\n[/message]\n')
-
-    def whisperOnWesnoth(self, target, message):
-        cfg = self.main.cfg
-        self.logOnIrc("<{}> -> <{}>: {}".format(cfg.username, target, message))
-        self.wes.send_wml_string('[whisper]\nmessage="' + re.sub('"', '""', message) +
-                                 '"\nreceiver="' + target + '"\nsender="spoof"\n[/whisper]\n')
+        self.logOnIrc("->{}: {}".format(room, message), session)
+        if session.wesSock is None:
+            self.log.warning("session %s is not connected, message dropped", session.name)
+            return
+        session.wesSock.scheduler.send("message", {"message": message, "room": room}, priority)
+
+    def whisperOnWesnoth(self, target, message, priority=False, session: 'WesSession' = None):
+        session = self.sessionOf(session)
+        cfg = session.cfg
+        self.logOnIrc("<{}> -> <{}>: {}".format(cfg.username, target, message), session)
+        if session.wesSock is None:
+            self.log.warning("session %s is not connected, whisper to %s dropped", session.name, target)
+            return
+        session.wesSock.scheduler.send("whisper", {"message": message, "receiver": target, "sender": "spoof"},
+                                       priority)
 
-    def sendPrivately(self, sender, origin, message):
+    def sendPrivately(self, sender, origin, message, priority=False, session: 'WesSession' = None):
         if type(message) != type(""):
             message = repr(message)
         if origin == "irc":
             self.irc.whisper(sender, message)
         elif origin == "wes":
-            self.whisperOnWesnoth(sender, message)
+            self.whisperOnWesnoth(sender, message, priority, session)
 
-    def logOnIrc(self, message):
+    def logOnIrc(self, message, session: 'WesSession' = None):
         cfg = self.main.cfg
-        self.main.messageLog.info(message)
+        session = self.sessionOf(session)
+        session.messageLog.info(message)
+        if session is not self.main.sessions[0]:
+            message = "[{}] {}".format(session.name, message)
         if cfg.ircEnabled:
             if self.irc:
                 self.irc.say(message)
@@ -381,7 +430,7 @@ $1 = number, default 1. Use <=1 to remove ping, example 0"""
         for user in self.pingUsers:
             # if user not in online:
             #    continue
-            interval, lastPing = self.pingUsers[user]
-            if lastPing + datetime.timedelta(minutes=interval) < now:
-                self.whisperOnWesnoth(user, "ping")
-                self.pingUsers[user] = (interval, now)
+            interval, lastPing, session = self.pingUsers[user]
+            if lastPing + datetime.timedelta(minutes=interval) < now and session.wesSock:
+                self.whisperOnWesnoth(user, "ping", session=session)
+                self.pingUsers[user] = (interval, now, session)
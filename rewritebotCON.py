@@ -1,56 +1,79 @@
+import asyncio
+import collections
 import logging
-import logging.handlers
 import gzip
+import zlib
 import socket
-import subprocess
-import os
+import time
 
 import wmlparser
 import typing
+from rewritebotCAP import CaptureWriter
+from rewritebotHASH import hashPassword
 
 if typing.TYPE_CHECKING:
-    from rewritebot import WesBot
+    from rewritebot import WesSession
 from rewritebotSCHEMA import WesException
 
 
 class WesSock:
-    LOG_RECEIVED = True
     socketTimeout = 1
     sock: socket.socket
 
-    def __init__(self, main: 'WesBot', version: str):
+    def __init__(self, main: 'WesSession', version: str):
         self.main = main
         self.wesnothVersion = version
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.settimeout(WesSock.socketTimeout)
-        self.log_sent = logging.getLogger("CON sent")
-        self.log_rec = logging.getLogger("CON rec")
-        fh_send = logging.handlers.RotatingFileHandler("log/wesbot_sent.log", maxBytes=10 * 1024 * 1024, backupCount=2)
-        fh_rec = logging.handlers.RotatingFileHandler("log/wesbot_rec.log", maxBytes=100 * 1024 * 1024, backupCount=2)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        fh_send.setFormatter(formatter)
-        fh_rec.setFormatter(formatter)
-        self.log_sent.setLevel(logging.DEBUG)
-        self.log_rec.setLevel(logging.DEBUG)
-        if self.log_sent.hasHandlers():
-            self.log_sent.handlers.clear()
-        if self.log_rec.hasHandlers():
-            self.log_rec.handlers.clear()
-        self.log_sent.addHandler(fh_send)
-        self.log_rec.addHandler(fh_rec)
-
-    def connect(self, host, port=15000):
-        self.sock.connect((host, port))
+        # Once attached to the event loop, everything is sent through it
+        self.loop = None
+        self.transport = None
+        # Done when the transport has sent what it had and closed, see shutdown
+        self.closing = None
+        self.reader = FrameReader()
+        self.encoder = FrameEncoder(main.cfg.wesGzipLevel)
+        self.scheduler = SendScheduler(self, main.cfg.wesSendLimit, main.cfg.wesSendWindow)
+        # Frames waiting for the transport to take more, see resume
+        self.queue = collections.deque()
+        self.paused = False
+        # For the message being received by the event loop
+        self.inflater = None
+        self.inflated = 0
+        self.captured = None  # its parts, if it is captured
+        # For the session's throughput
+        self.receivedBytes = 0
+        self.receivedMessages = 0
+        self.sentBytes = 0
+        self.sentMessages = 0
+        cfg = main.cfg
+        suffix = main.fileSuffix
+        self.capture = CaptureWriter("log/wesbot_rec{}.cap".format(suffix), cfg.wesCaptureMaxBytes, 2,
+                                     cfg.wesCaptureSample, cfg.wesCaptureEnabled)
+        self.log_sent = main.sentLog
+        # Reused for building every outgoing message
+        self.writer = wmlparser.WMLWriter()
+
+    def connect(self, host, port=15000, address=None):
+        """
+        Connects to host:port, or to address if it was resolved before.
+        If the server sends the bot on to another port, that is followed,
+        and host, port and address are those of the server connected to.
+        """
+        if address is None:
+            address = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)[0][4]
+        self.sock.connect(address)
+        self.host, self.port, self.address = host, port, address
         # and ensure correct port
         self._handshake()
         if "[version]" not in self.receive_string():
             raise WesException("Server did not ask for version").quit()
 
-        self.send_wml_string('[version]\nversion="' + self.wesnothVersion + '"\n[/version]\n')
+        self.send_tag("version", version=self.wesnothVersion)
 
-        response = self.receive_string()
+        response = self.receive_bytes()
         parser = wmlparser.Parser(None)
-        wml = parser.parse_text(response)
+        parser.track_locations = False
+        wml = parser.parse_binary(response)
         result = {}
         if type(wml) is wmlparser.RootNode:
             wml = wml.get_all()
@@ -62,10 +85,13 @@ class WesSock:
             self.shutdown()
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.settimeout(WesSock.socketTimeout)
-            self.connect(result["host"], int(result["port"]))
+            self.reader = FrameReader()
+            port = int(result["port"])
+            # Usually only the port changes, then the address is still good
+            self.connect(result["host"], port, (address[0], port) if result["host"] == host else None)
 
     def loginLobby(self, name, password) -> bool:
-        self.send_wml_string('[login]\npassword=""\nusername="' + name + '"\n[/login]')
+        self.send_tag("login", password="", username=name)
         result = self.receive_string()
         self.main.log.info("Login process: %s", result)
 
@@ -79,18 +105,9 @@ class WesSock:
                 salt = line.split("=")[1]
 
         if salt != "":
-            if os.name == "nt":
-                process = subprocess.Popen('hashwes.exe' + ' ' + password + ' ' + salt,
-                                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-            else:
-                # segmentation fault without that strip
-                salt = salt.strip('"')
-                process = subprocess.Popen("./hashwes '{}' '{}'".format(password, salt),
-                                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-            passhash = process.communicate()[0].decode("utf8")
+            passhash = hashPassword(password, salt)
             self.main.log.info("receive passhash %s from salt %s on user %s", passhash, salt, name)
-            self.send_wml_string(
-                '[login]\nforce_confirmation="yes"\npassword="' + passhash + '"\nusername="' + name + '"\n[/login]')
+            self.send_tag("login", force_confirmation="yes", password=passhash, username=name)
             result = self.receive_string()
         self.main.log.debug("Auth process: %s", result)
         if "[join_lobby]\n[/join_lobby]" == result.strip():
@@ -105,6 +122,14 @@ class WesSock:
         return False
 
     def _send_bytes(self, msg: bytes):
+        self.sentBytes += len(msg)
+        self.sentMessages += 1
+        if self.transport is not None:
+            if self.paused or self.queue:
+                self.queue.append(msg)
+            else:
+                self.transport.write(msg)
+            return
         totalsent = 0
         MSGLEN = len(msg)
         while totalsent < MSGLEN:
@@ -114,58 +139,388 @@ class WesSock:
             totalsent = totalsent + sent
 
     def send_wml_string(self, msg):
-        if type(msg) != type(""):
-            msg = repr(msg)
-        self.log_sent.debug(msg)
-        msg = msg.encode()
-        msg = gzip.compress(msg)
-        msg = bytes(msg)
-        msglen = (len(msg)).to_bytes(4, byteorder='big')
-        self._send_bytes(msglen + msg)
+        if isinstance(msg, (bytes, bytearray)):
+            if self.log_sent.isEnabledFor(logging.DEBUG):
+                self.log_sent.debug(msg.decode("utf8", "replace"))
+        else:
+            if type(msg) != type(""):
+                msg = repr(msg)
+            self.log_sent.debug(msg)
+            msg = msg.encode()
+        self._send_bytes(self.encoder.frame(bytes(msg)))
+
+    def send_tag(self, tag_name, **attributes):
+        """Sends [tag_name] with the given attributes, values are quoted and escaped"""
+        try:
+            self.send_wml_string(self.writer.tag(tag_name, **attributes).getvalue())
+        finally:
+            self.writer.reset()
 
     def _handshake(self):
         self._send_bytes(bytes([0x00, 0x00, 0x00, 0x00]))
         reply = self.sock.recv(4)
         self.main.log.debug("handshake reply %s %s %s", reply, "socket number", int.from_bytes(reply, byteorder="big"))
 
-    def _receive_byte_string(self) -> bytes:
+    def receive_bytes(self) -> bytes:
         try:
-            chunks = []
-            bytes_recd = 0
-            chunk = self.sock.recv(4)
-            if len(chunk) == 0:
-                raise WesException("wes recv len 0").addAction(WesException.QUIT_WES)
-
-            bytes_wanted = int.from_bytes(chunk, byteorder="big")
-            while bytes_recd != bytes_wanted:
-                chunk = self.sock.recv(min(4096, bytes_wanted - bytes_recd))
-                if not chunk:
-                    self.main.log.warn("chunk not")
-                    break
-                if chunk == b'':
-                    raise WesException("socket connection broken").addAction(WesException.QUIT_WES)
-                chunks.append(chunk)
-
-                bytes_recd = bytes_recd + len(chunk)
-            try:
-                result: bytes = gzip.decompress(b''.join(chunks))
-            except OSError:
-                self.main.log.error("Problem when decompressing received chunks")
-                self.main.log.error("Bytes wanted {}".format(bytes_wanted))
-                self.main.log.error("Bytes read {}".format(bytes_recd))
-                self.main.log.error(b''.join(chunks))
-                raise
-            if len(result) == 0:
-                raise WesException("Received empty, so quitting").addAction(WesException.QUIT_WES)
-            if self.LOG_RECEIVED:
-                self.log_rec.debug(result)
-            return result
+            while True:
+                frame = self.reader.nextFrame()
+                if frame is not None:
+                    return self._decompress(frame)
+                # A frame cut by the timeout is completed by the next call
+                if self.reader.recv(self.sock) == 0:
+                    raise WesException("wes recv len 0").addAction(WesException.QUIT_WES)
         except socket.timeout:
             return b''
 
+    def _decompress(self, frame) -> bytes:
+        try:
+            result: bytes = gzip.decompress(frame)
+        except OSError:
+            self.main.log.error("Problem when decompressing received chunks")
+            self.main.log.error("Bytes read {}".format(len(frame)))
+            self.main.log.error(bytes(frame))
+            raise
+        if len(result) == 0:
+            raise WesException("Received empty, so quitting").addAction(WesException.QUIT_WES)
+        if self.capture.wants():
+            self.capture.write(bytes(frame))
+        return result
+
     def receive_string(self) -> str:
-        return self._receive_byte_string().decode("utf8")
+        return self.receive_bytes().decode("utf8")
+
+    async def attach(self, loop: asyncio.AbstractEventLoop):
+        """
+        Lets loop read the connected socket. Once the session has this
+        WesSock, each message is acted on as soon as it has arrived, see
+        actOnFrames.
+        """
+        self.loop = loop
+        await loop.create_connection(lambda: WesProtocol(self), sock=self.sock)
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        """
+        Writes the queued frames, until the transport has enough again.
+        """
+        self.paused = False
+        while self.queue and not self.paused and self.transport is not None:
+            self.transport.write(self.queue.popleft())
+
+    def actOnFrames(self):
+        """
+        Inflates what has arrived of the messages and passes it to the
+        Actor, which acts on the tags completed so far. The messages wait
+        in the reader until the session has taken this WesSock.
+        """
+        while self.transport is not None and self.main.wesSock is self and not self.main.stopped.done():
+            part = self.reader.nextPart()
+            if part is None:
+                return
+            self.main.runGuarded(self.onPart, *part)
+
+    def onPart(self, part, complete: bool):
+        actor = self.main.actor
+        if self.inflater is None:
+            self.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self.inflated = 0
+            self.captured = [] if self.capture.wants() else None
+            actor.startData()
+        if self.captured is not None:
+            self.captured.append(bytes(part))
+        self.receivedBytes += len(part)
+        try:
+            data = self.inflater.decompress(part)
+            if complete:
+                data += self.inflater.flush()
+        except zlib.error:
+            self.main.log.error("Problem when decompressing received chunks")
+            self.main.log.error(bytes(part))
+            raise
+        if data:
+            self.inflated += len(data)
+            actor.feedData(data)
+        if complete:
+            self.inflater = None
+            if not self.inflated:
+                raise WesException("Received empty, so quitting").addAction(WesException.QUIT_WES)
+            if self.captured is not None:
+                self.capture.write(b"".join(self.captured))
+                self.captured = None
+            self.receivedMessages += 1
+            actor.endData()
 
-    def shutdown(self):
-        self.sock.shutdown(socket.SHUT_RDWR)
+    def connectionLost(self):
+        if self.closing is not None:
+            self.closing.set_result(None)
+        elif self.transport is not None:
+            self.transport = None
+            self.main.stop(WesException("wes connection lost").addAction(WesException.QUIT_WES))
+
+    def shutdown(self) -> typing.Optional[asyncio.Future]:
+        """
+        Closes the connection. If it is attached, the transport first sends
+        what was written to it and the queued frames, while the loop runs;
+        the returned future is done once it has, and the capture thread
+        has written its frames.
+        """
+        self.capture.close()
+        if self.transport is not None:
+            transport = self.transport
+            self.transport = None
+            self.closing = self.loop.create_future()
+            while self.queue:
+                transport.write(self.queue.popleft())
+            transport.close()
+            return asyncio.gather(self.closing, self.loop.run_in_executor(None, self.capture.join))
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # not connected
         self.sock.close()
+        return None
+
+
+class SendScheduler:
+    """
+    Sends the chat messages ([whisper] and [message]) of a WesSock, no
+    more than limit of them in any window seconds, so that they are not
+    dropped by the server's flood protection. Messages that have to wait
+    are queued per recipient, and the recipients take turns.
+    A message is appended to the last one queued for its recipient if
+    the result is not too long. Priority messages go before all others.
+    """
+
+    MAX_LENGTH = 256  # wesnothd truncates longer messages
+    MAX_QUEUED = 20  # per recipient, the oldest messages are dropped
+
+    def __init__(self, wes: WesSock, limit: int, window: float):
+        self.wes = wes
+        self.limit = limit
+        self.window = window
+        # When the messages of the last window seconds were sent
+        self.sentTimes = collections.deque()
+        # Of [recipient, tag, attributes]
+        self.priority = collections.deque()
+        self.queues = collections.OrderedDict()  # recipient -> deque
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def send(self, tag: str, attributes: dict, priority=False):
+        recipient = (tag, attributes.get("receiver", attributes.get("room")))
+        queue = self.priority if priority else self.queues.get(recipient)
+        if queue is None:
+            queue = self.queues[recipient] = collections.deque()
+        elif queue and queue[-1][0] == recipient:
+            last = queue[-1][2]
+            message = last["message"] + "\n" + attributes["message"]
+            if len(message) <= SendScheduler.MAX_LENGTH:
+                last["message"] = message
+                self.coalesced += 1
+                return
+        queue.append([recipient, tag, dict(attributes)])
+        if not priority and len(queue) > SendScheduler.MAX_QUEUED:
+            queue.popleft()
+            self.dropped += 1
+        self.flush()
+
+    def flush(self):
+        """
+        Sends what the window allows by now, called again every second.
+        """
+        now = time.monotonic()
+        while self.sentTimes and now - self.sentTimes[0] >= self.window:
+            self.sentTimes.popleft()
+        while len(self.sentTimes) < self.limit:
+            if self.priority:
+                recipient, tag, attributes = self.priority.popleft()
+            elif self.queues:
+                recipient, queue = self.queues.popitem(last=False)
+                recipient, tag, attributes = queue.popleft()
+                if queue:
+                    self.queues[recipient] = queue
+            else:
+                return
+            self.sentTimes.append(now)
+            self.sent += 1
+            self.wes.send_tag(tag, **attributes)
+
+    def queued(self) -> int:
+        return len(self.priority) + sum(len(queue) for queue in self.queues.values())
+
+    def getStats(self):
+        return "Sent messages: {}, queued: {}, coalesced: {}, dropped: {}".format(
+            self.sent, self.queued(), self.coalesced, self.dropped)
+
+
+class FrameEncoder:
+    """
+    Gzips and frames outgoing messages. The frames of recent short
+    messages are kept, so that constant ones like [leave_game] or a
+    ping whisper are only compressed once.
+    """
+
+    MAX_CACHED_LENGTH = 1024
+
+    def __init__(self, level=9, entries=256):
+        self.level = level
+        self.entries = entries
+        self.cache = collections.OrderedDict()
+
+    def frame(self, msg: bytes) -> bytes:
+        framed = self.cache.get(msg)
+        if framed is not None:
+            self.cache.move_to_end(msg)
+            return framed
+        data = gzip.compress(msg, self.level)
+        framed = len(data).to_bytes(4, byteorder="big") + data
+        if self.entries and len(msg) <= FrameEncoder.MAX_CACHED_LENGTH:
+            self.cache[msg] = framed
+            if len(self.cache) > self.entries:
+                self.cache.popitem(last=False)
+        return framed
+
+
+class FrameReader:
+    """
+    Collects what the server sends, a 4 byte length followed by that many
+    bytes of gzipped WML per message, in one reused buffer. Data is read
+    straight into it (see recv, or getBuffer and bufferUpdated), so a
+    frame is only copied if its consumer does. Frames may be split
+    anywhere between reads, and one read may complete several. They are
+    returned whole by nextFrame, or by nextPart as they arrive.
+    """
+
+    # Free space offered for reading while no larger frame is expected
+    READ_SIZE = 1 << 16
+
+    def __init__(self):
+        self.buffer = bytearray(FrameReader.READ_SIZE)
+        # The received bytes not yet returned are buffer[start:end]
+        self.start = 0
+        self.end = 0
+        # Bytes of the frame returned in parts by nextPart still to come
+        self.remaining = None
+
+    def getBuffer(self) -> memoryview:
+        """
+        Returns the free part of the buffer. Unless the frame is returned
+        in parts, it is large enough for the rest of the frame.
+        """
+        wanted = FrameReader.READ_SIZE
+        if self.remaining is None and self.end - self.start >= 4:
+            header = self.buffer[self.start:self.start + 4]
+            wanted = max(wanted, self.start + 4 + int.from_bytes(header, byteorder="big") - self.end)
+        if len(self.buffer) - self.end < wanted:
+            pending = self.end - self.start
+            if pending + wanted > len(self.buffer):
+                # Not resized in place, the returned frames may still be referenced
+                buffer = bytearray(max(2 * len(self.buffer), pending + wanted))
+            else:
+                buffer = self.buffer
+            buffer[:pending] = self.buffer[self.start:self.end]
+            self.buffer = buffer
+            self.start = 0
+            self.end = pending
+        return memoryview(self.buffer)[self.end:]
+
+    def bufferUpdated(self, nbytes: int):
+        """
+        Tells that nbytes were written to the start of getBuffer().
+        """
+        self.end += nbytes
+
+    def recv(self, sock: socket.socket) -> int:
+        """
+        Reads once from sock, returns the number of bytes read.
+        """
+        with self.getBuffer() as free:
+            nbytes = sock.recv_into(free)
+        self.bufferUpdated(nbytes)
+        return nbytes
+
+    def feed(self, data: bytes):
+        with self.getBuffer() as free:
+            if len(free) < len(data):
+                raise ValueError("FrameReader.feed got more than READ_SIZE bytes")
+            free[:len(data)] = data
+        self.bufferUpdated(len(data))
+
+    def nextFrame(self) -> typing.Optional[memoryview]:
+        """
+        Returns the next complete frame without its length, or None. The
+        memoryview is only valid until the next getBuffer.
+        """
+        start = self.start
+        if self.end - start < 4:
+            return None
+        end = start + 4 + int.from_bytes(self.buffer[start:start + 4], byteorder="big")
+        if end > self.end:
+            return None
+        self.start = end
+        return memoryview(self.buffer)[start + 4:end]
+
+    def nextPart(self) -> typing.Optional[typing.Tuple[memoryview, bool]]:
+        """
+        Returns the bytes of the current frame received since the last
+        call and whether that completes the frame, or None if there are
+        none. A frame may be returned in a single part, an empty one
+        only if the frame is empty. Like for nextFrame, the memoryview is
+        valid until the next getBuffer. nextFrame must not be called
+        while a frame is returned in parts.
+        """
+        if self.remaining is None:
+            if self.end - self.start < 4:
+                return None
+            self.remaining = int.from_bytes(self.buffer[self.start:self.start + 4], byteorder="big")
+            self.start += 4
+        start = self.start
+        size = min(self.remaining, self.end - start)
+        if size == 0 and self.remaining:
+            return None
+        self.start += size
+        self.remaining -= size
+        complete = self.remaining == 0
+        if complete:
+            self.remaining = None
+        return memoryview(self.buffer)[start:start + size], complete
+
+
+# asyncio.BufferedProtocol (Python 3.7) lets the loop read into the FrameReader
+class WesProtocol(getattr(asyncio, "BufferedProtocol", asyncio.Protocol)):
+    """
+    Passes the messages the server sends to an attached WesSock.
+    """
+
+    def __init__(self, wes: WesSock):
+        self.wes = wes
+
+    def connection_made(self, transport):
+        self.wes.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.wes.reader.getBuffer()
+
+    def buffer_updated(self, nbytes):
+        self.wes.reader.bufferUpdated(nbytes)
+        self.wes.actOnFrames()
+
+    def data_received(self, data):
+        # Without BufferedProtocol
+        view = memoryview(data)
+        for i in range(0, len(data), FrameReader.READ_SIZE):
+            self.wes.reader.feed(view[i:i + FrameReader.READ_SIZE])
+        self.wes.actOnFrames()
+
+    def pause_writing(self):
+        self.wes.pause()
+
+    def resume_writing(self):
+        self.wes.resume()
+
+    def connection_lost(self, exc):
+        self.wes.connectionLost()
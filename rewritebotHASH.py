@@ -0,0 +1,80 @@
+import functools
+import hashlib
+
+# The alphabet of the phpass hashes the server's salts come from
+ITOA64 = "./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+
+@functools.lru_cache(maxsize=16)
+def hashPassword(password: str, salt: str) -> str:
+    """
+    The password hash the server expects for the salt it sent, what
+    hashwes prints: salt is a phpass hash prefix ("$H$" and a character
+    for the number of iterations, then 8 characters of salt) followed
+    by 8 more characters of salt for this login.
+
+    Unlike hashwes, an MD5 digest containing a zero byte is hashed whole,
+    as Wesnoth does; hashwes copied it as a string, up to the zero.
+    """
+    salt = salt.strip('"')
+    if len(salt) < 20:
+        raise ValueError("salt {} is too short".format(salt))
+    hashed = storedHash(password, salt[:12])
+    return encodeHash(createHash(hashed.encode(), salt[12:20].encode(), 10))
+
+
+@functools.lru_cache(maxsize=16)
+def storedHash(password: str, salt: str) -> str:
+    """
+    The hash of password the server has stored, the first 12 characters of
+    the salt are the same for every login. Remembered for reconnecting.
+    """
+    return encodeHash(createHash(password.encode("utf8"), salt[4:12].encode(), getIteration(salt)))
+
+
+def getIteration(salt: str) -> int:
+    """
+    The base 2 logarithm of the number of iterations, coded by salt[3].
+    """
+    iteration = ITOA64.find(salt[3])
+    if iteration < 0:
+        raise ValueError("salt {} does not give the number of iterations".format(salt))
+    return iteration
+
+
+def createHash(password: bytes, salt: bytes, iteration: int) -> bytes:
+    """
+    Salted MD5 of password, hashed again with password 2**iteration times.
+    """
+    digest = hashlib.md5(salt + password).digest()
+    for _ in range(1 << iteration):
+        digest = hashlib.md5(digest + password).digest()
+    return digest
+
+
+def encodeHash(digest: bytes) -> str:
+    """
+    Encodes digest in ITOA64, 6 bits per character starting from the
+    lowest bits, as phpass does; 22 characters for an MD5 digest.
+    """
+    result = []
+    count = len(digest)
+    i = 0
+    while i < count:
+        value = digest[i]
+        i += 1
+        result.append(ITOA64[value & 0x3f])
+        if i < count:
+            value |= digest[i] << 8
+        result.append(ITOA64[(value >> 6) & 0x3f])
+        if i >= count:
+            break
+        i += 1
+        if i < count:
+            value |= digest[i] << 16
+        result.append(ITOA64[(value >> 12) & 0x3f])
+        if i >= count:
+            break
+        i += 1
+        result.append(ITOA64[(value >> 18) & 0x3f])
+    return "".join(result)
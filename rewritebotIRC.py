@@ -1,6 +1,9 @@
+import asyncio
+import collections
 import logging
 import logging.handlers
 import socket
+import time
 import typing
 
 from rewritebotSCHEMA import WesException
@@ -30,11 +33,19 @@ class WesIrc:
         fh.setFormatter(formatter)
         self.log.setLevel(logging.DEBUG)
         if self.log.hasHandlers():
+            for handler in self.log.handlers:
+                handler.close()
             self.log.handlers.clear()
         self.log.addHandler(fh)
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.settimeout(WesIrc.socketTimeout)
-        self.responseBuffer = ""
+        self.responseBuffer = b""
+        # Once attached to the event loop, everything is sent through it
+        self.loop = None
+        self.transport = None
+        # Done when the transport has sent what it had and closed, see shutdown
+        self.closing = None
+        self.queue = IrcSendQueue(self, cfg.ircSendRate, cfg.ircSendBurst)
 
     def connect(self):
         self.sock.connect((self.network, self.port))
@@ -67,81 +78,79 @@ class WesIrc:
             self.log.log(5, "send %s", msg.strip())
         else:
             self.log.debug("send %s", msg.strip())
-        self.sock.send(msg.encode())
+        self._send_bytes(msg.encode())
+
+    def _send_bytes(self, msg: bytes):
+        if self.transport is not None:
+            self.transport.write(msg)
+        else:
+            self.sock.send(msg)
 
     def say(self, msg: str):
-        if type(msg) != type(''):
-            msg = repr(msg)
-        msg = msg.replace("\n", " ")
-        msg = msg.replace("\r", "")
-        if not self.connected:
-            self.log.warning("say called without connection")
-            return
-        self.log.debug("send %s", ('PRIVMSG ' + self.homechan + ' :' + msg + '\r\n').strip())
-        msg = msg.replace("Laela", "L" + u"\u200B" + "aela")
-        msg = msg.replace("Ravana", "R" + u"\u200B" + "avana")
-        # print("saying",msg)
-        try:
-            self.sock.send(('PRIVMSG ' + self.homechan + ' :' + msg + '\r\n').encode())
-        except:
-            self.log.error("sock.send errored")
+        self.privmsg(self.homechan, msg)
 
     def whisper(self, target: str, msg: str):
+        self.privmsg(target, msg)
+
+    def privmsg(self, target: str, msg: str):
+        """
+        Queues msg to target, on as many lines as it needs, see IrcSendQueue.
+        """
         if type(msg) != type(''):
             msg = repr(msg)
         msg = msg.replace("\n", " ")
         msg = msg.replace("\r", "")
         if not self.connected:
-            self.log.warning("whisper called without connection")
+            self.log.warning("privmsg called without connection")
             return
         msg = msg.replace("Laela", "L" + u"\u200B" + "aela")
         msg = msg.replace("Ravana", "R" + u"\u200B" + "avana")
-        self.log.debug("send %s", ('PRIVMSG ' + target + ' :' + msg + '\r\n').strip())
-        self.sock.send(('PRIVMSG ' + target + ' :' + msg + '\r\n').encode())
-
-    def receive(self):
-        try:
-            response: str = self.sock.recv(4096).decode("utf8")
-            response = self.responseBuffer + response
-            # if len(response) == 0:
-            #     raise WesException("IRC recv returned len 0").addAction(WesException.QUIT_IRC)
-            self.responseBuffer = ""
-            splitlines = response.splitlines(True)
-            unhandledResponse = ""
-            for i in range(len(splitlines)):
-                line = splitlines[i]
-                if len(line) == len(line.rstrip()):
-                    if i == len(splitlines) - 1:
-                        # Save it to buffer
-                        self.responseBuffer = line
-                        break
-                    else:
-                        # Line does not end with newline symbol, but there is another line somehow, should never happen
-                        raise WesException("line without newline but is not last").addAction(WesException.QUIT_IRC)
-                if not self._actOnLine(line):
-                    unhandledResponse += line
-            return unhandledResponse
-        except socket.timeout:
-            self.ensure_connected()
-            return ""
-
-    def _actOnLine(self, line):
-        if line.startswith("PING"):
-            self.log.log(5, "recv %s", line.strip())
-            self.send(line.replace("PING", "PONG", 1).strip("\r\n") + "\r\n")
+        command = 'PRIVMSG ' + target + ' :'
+        for part in splitMessage(msg, IrcSendQueue.MAX_LINE - IrcSendQueue.RELAY_PREFIX - len(command.encode()) - 2):
+            line = command.encode() + part
+            self.log.debug("send %s", line.decode("utf8"))
+            self.queue.send(line + b"\r\n")
+
+    def onData(self, data: bytes):
+        """
+        Parses the complete lines received so far and acts on them in
+        order, passing the messages it does not handle itself to the
+        command handler.
+        """
+        lines = (self.responseBuffer + data).split(b"\n")
+        # The last one is not complete yet, b"" if data ended with a newline
+        self.responseBuffer = lines.pop()
+        messages = [IrcMessage.parse(decodeLine(line)) for line in lines if line.strip()]
+        for message in messages:
+            if self.main.stopped.done():
+                break
+            self.main.runGuarded(self.onMessage, message)
+
+    def onMessage(self, message: 'IrcMessage'):
+        if self._actOnMessage(message):
+            return
+        if message.command == "PRIVMSG" and len(message.params) > 1:
+            self.main.commandHandler.onIrcMessage(message)
+
+    def _actOnMessage(self, message: 'IrcMessage'):
+        cfg = self.main.cfg
+        if message.command == "PING":
+            self.log.log(5, "recv %s", message.line)
+            self.send(message.line.replace("PING", "PONG", 1) + "\r\n")
             return True
-        self.log.debug("recv %s", line.strip())
-        # TODO filter it to avoid spoofing this message
-        if "451 JOIN :You have not registered" in line:
+        self.log.debug("recv %s", message.line)
+        # ERR_NOTREGISTERED
+        if message.command == "451":
             self.login()
             return True
         # :NickServ MODE Rav_bot :+r
-        if ":NickServ MODE {} :+r".format(self.main.cfg.ircName) == line.strip():
+        if message.command == "MODE" and message.nick == "NickServ" and message.params == [cfg.ircName, "+r"]:
             self.auth = True
             self.join(self.homechan)
             return True
-        # TODO filter it to avoid spoofing this message
-        if "MODE {} +ao {}".format(self.homechan, self.main.cfg.ircName) in line or "MODE {} +o {}".format(self.homechan, self.main.cfg.ircName) in line:
+        # :ChanServ MODE #wesnoth-bot +ao Rav_bot
+        if message.command == "MODE" and message.params[:1] == [self.homechan] and \
+                message.params[1:] in (["+ao", cfg.ircName], ["+o", cfg.ircName]):
             self.inChannel = True
             return True
         return False
@@ -152,8 +161,198 @@ class WesIrc:
     def part(self, chan: str):
         self.send(('PART ' + chan + '\r\n'))
 
-    def shutdown(self):
+    async def attach(self, loop: asyncio.AbstractEventLoop):
+        """
+        Lets loop read the connected socket, acting on each line as soon
+        as it has arrived.
+        """
+        self.loop = loop
+        await loop.create_connection(lambda: IrcProtocol(self), sock=self.sock)
+
+    def connectionLost(self):
+        if self.closing is not None:
+            self.closing.set_result(None)
+        elif self.transport is not None:
+            self.transport = None
+            self.connected = False
+            self.main.stop(WesException("irc connection lost").reconnectIrc())
+
+    def shutdown(self) -> typing.Optional[asyncio.Future]:
+        """
+        Closes the connection. If it is attached, the queued lines are
+        written at once and the transport sends them while the loop runs;
+        the returned future is done once it has.
+        """
+        if self.transport is not None:
+            self.queue.drain()
+            transport = self.transport
+            self.transport = None
+            self.connected = False
+            self.closing = self.loop.create_future()
+            transport.close()
+            return self.closing
         if self.connected:
             self.sock.shutdown(socket.SHUT_RDWR)
             self.sock.close()
             self.connected = False
+        return None
+
+
+class IrcSendQueue:
+    """
+    Sends the PRIVMSG lines of a WesIrc at no more than rate per second,
+    with bursts of up to burst, so that the network does not kick the
+    bot for flooding. The lines wait in order, but only while attached
+    to the event loop, whose transport does not block on writing.
+    """
+
+    MAX_LINE = 512  # bytes, with the CRLF
+    RELAY_PREFIX = 100  # for the ":nick!user@host " the server adds when relaying a line
+    MAX_QUEUED = 100  # the oldest lines are dropped
+
+    def __init__(self, irc: WesIrc, rate: float, burst: int):
+        self.irc = irc
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lines = collections.deque()
+        # While the transport has enough to write
+        self.paused = False
+        self.sent = 0
+        self.dropped = 0
+
+    def send(self, line: bytes):
+        self.lines.append(line)
+        if len(self.lines) > IrcSendQueue.MAX_QUEUED:
+            self.lines.popleft()
+            self.dropped += 1
+        self.flush()
+
+    def flush(self):
+        """
+        Sends what the rate allows by now, called again every second.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        while self.tokens >= 1 and self.lines and not self.paused and self.irc.transport is not None:
+            self.tokens -= 1
+            self.sent += 1
+            self.irc.transport.write(self.lines.popleft())
+
+    def drain(self):
+        """
+        Writes all the queued lines, without waiting for the rate, before
+        the connection is closed.
+        """
+        while self.lines and self.irc.transport is not None:
+            self.sent += 1
+            self.irc.transport.write(self.lines.popleft())
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self.flush()
+
+    def getStats(self):
+        return "IRC lines sent: {}, queued: {}, dropped: {}".format(self.sent, len(self.lines), self.dropped)
+
+
+def splitMessage(msg: str, limit: int) -> typing.List[bytes]:
+    """
+    Encodes msg in parts of at most limit bytes, split at a space if
+    there is one in the second half of the part (which is left out),
+    and never inside a character.
+    """
+    data = msg.encode("utf8")
+    parts = []
+    while len(data) > limit:
+        end = limit
+        # Not before a continuation byte of a character
+        while data[end] & 0xC0 == 0x80:
+            end -= 1
+        space = data.rfind(b" ", limit // 2, end)
+        if space >= 0:
+            parts.append(data[:space])
+            data = data[space + 1:]
+        else:
+            parts.append(data[:end])
+            data = data[end:]
+    parts.append(data)
+    return parts
+
+
+def decodeLine(line: bytes) -> str:
+    line = line.rstrip(b"\r")
+    try:
+        return line.decode("utf8")
+    except UnicodeDecodeError:
+        # Older clients send latin-1
+        return line.decode("latin-1")
+
+
+class IrcMessage:
+    """
+    A line received from IRC, split as in RFC 1459 into the optional
+    prefix (the sender), the command and its parameters. The trailing
+    parameter, after " :", may contain spaces.
+    """
+
+    def __init__(self, line: str, prefix: str, command: str, params: typing.List[str]):
+        self.line = line
+        self.prefix = prefix
+        self.command = command
+        self.params = params
+
+    @staticmethod
+    def parse(line: str) -> 'IrcMessage':
+        rest = line
+        if rest.startswith("@"):
+            # IRCv3 message tags are not used
+            rest = rest.partition(" ")[2]
+        prefix = ""
+        if rest.startswith(":"):
+            prefix, _, rest = rest[1:].partition(" ")
+        rest, separator, trailing = rest.partition(" :")
+        params = rest.split()
+        if separator:
+            params.append(trailing)
+        command = params.pop(0).upper() if params else ""
+        return IrcMessage(line, prefix, command, params)
+
+    @property
+    def nick(self) -> str:
+        """
+        The nick of the sender, or the server's name.
+        """
+        return self.prefix.split("!", 1)[0]
+
+    def __repr__(self):
+        return "IrcMessage({!r}, {!r}, {!r})".format(self.prefix, self.command, self.params)
+
+
+class IrcProtocol(asyncio.Protocol):
+    """
+    Passes what the IRC server sends to an attached WesIrc.
+    """
+
+    def __init__(self, irc: WesIrc):
+        self.irc = irc
+
+    def connection_made(self, transport):
+        self.irc.transport = transport
+
+    def data_received(self, data):
+        self.irc.main.runGuarded(self.irc.onData, data)
+
+    def pause_writing(self):
+        self.irc.queue.pause()
+
+    def resume_writing(self):
+        self.irc.queue.resume()
+
+    def connection_lost(self, exc):
+        self.irc.connectionLost()
@@ -12,7 +12,7 @@ import wmlparser
 import typing
 
 if typing.TYPE_CHECKING:
-    from rewritebot import WesBot
+    from rewritebot import WesSession
     from logging import Logger
 
 
@@ -59,8 +59,8 @@ class WesException(Exception):
 
 
 class Game:
+    # The node is not kept, only these values, so that the parsed tree can be freed
     def __init__(self, node: wmlparser.TagNode):
-        self.node = node
         self.id = node.get_text_val("id")
         self.name = node.get_text_val("name")
         self.mp_scenario = node.get_text_val("mp_scenario")
@@ -68,12 +68,26 @@ class Game:
         self.mp_use_map_settings = node.get_text_val("mp_use_map_settings")
         self.observer = node.get_text_val("observer") == "yes"
         # self.human_sides = node.get_text_val("human_sides") # TODO find why I had human_sides there
-        # TODO use [slot_data], [slot_data]\nmax="2"\nvacant="0"\n[/slot_data]
+        # [slot_data]\nmax="2"\nvacant="0"\n[/slot_data]
+        self.slots_max = node.first("slot_data/@max")
+        self.slots_vacant = node.first("slot_data/@vacant")
         self.users = []
 
+    def setAttribute(self, name: str, value: str):
+        # For [change_child] in [gamelist_diff], value is None for a deleted attribute
+        if name == "observer":
+            self.observer = value == "yes"
+        elif name in ("name", "mp_scenario", "mp_era", "mp_use_map_settings"):
+            setattr(self, name, value)
+        elif name == "slot_data/max":
+            self.slots_max = value
+        elif name == "slot_data/vacant":
+            self.slots_vacant = value
+
     def debug(self):
-        # return "Game: %s: %s" % (self.id, self.name)
-        return self.node.debug()
+        return "Game: %s: %s, scenario=%s, era=%s, observer=%s, slots=%s/%s" % (
+            self.id, self.name, self.mp_scenario, self.mp_era, self.observer,
+            self.slots_vacant, self.slots_max)
 
     def __repr__(self):
         return self.__str__()
@@ -86,7 +100,7 @@ class GameHolder:
     _gameList: List[Game]
     _gameMap: Dict[int, Game]  # game id -> game # TODO check if this gets too large and needs to be cleared
 
-    def __init__(self, main: 'WesBot', lobby: 'LobbyHolder'):
+    def __init__(self, main: 'WesSession', lobby: 'LobbyHolder'):
         self.lobby = lobby
         self.main = main
         self._gameList = []
@@ -111,6 +125,11 @@ class GameHolder:
     def getGames(self):
         return self._gameList
 
+    def getI(self, index: int) -> Game:
+        WesException.ensure(len(self._gameList) > index, "Game list {} has no index {}"
+                            .format(str(self._gameList), index))
+        return self._gameList[index]
+
     def insertGame(self, g: Game, index):
         WesException.ensure(index <= len(self._gameList),
                             "index ({}) <= len(self._gameList) ({})".format(index, len(self._gameList)))
@@ -131,8 +150,8 @@ class GameHolder:
 # //and then when the delete is processed we'll slide into the right position
 
 class User:
+    # The node is not kept, only these values, so that the parsed tree can be freed
     def __init__(self, node: wmlparser.TagNode):
-        self.node = node
         self.available = node.get_text_val("available")
         self.game_id = node.get_text_val("game_id")
         self.location = node.get_text_val("location")
@@ -140,9 +159,16 @@ class User:
         self.registered = node.get_text_val("registered") == "yes"
         self.status = node.get_text_val("status")
 
+    def setAttribute(self, name: str, value: str):
+        # For [change_child] in [gamelist_diff], value is None for a deleted attribute
+        if name == "registered":
+            self.registered = value == "yes"
+        elif name in ("available", "game_id", "location", "status"):
+            setattr(self, name, value)
+
     def debug(self):
-        # return "User(" + self.name + ", registered=" + str(self.registered) + ")"
-        return self.node.debug()
+        return "User(%s, registered=%s, status=%s, game_id=%s, location=%s, available=%s)" % (
+            self.name, self.registered, self.status, self.game_id, self.location, self.available)
 
     def __repr__(self):
         return self.__str__()
@@ -155,7 +181,7 @@ class UserHolder:
     _users: Dict[str, User]
     _userList: List[User]
 
-    def __init__(self, main: 'WesBot', lobby: 'LobbyHolder'):
+    def __init__(self, main: 'WesSession', lobby: 'LobbyHolder'):
         self.lobby = lobby
         self.main = main
         self._users = {}  # name -> user
@@ -252,14 +278,19 @@ class StatsHolder:
     # User logs out
     # User join game
     # User leaves game
-    connectTimes: List[float] = [0]
-    userEvents = WeakList()
-    userEventsView: Dict[str, List[UserEvent]] = defaultdict(list)
+    connectTimes: List[float]
+    userEvents: WeakList
+    userEventsView: Dict[str, List[UserEvent]]
 
-    def __init__(self, main: 'WesBot', log) -> None:
+    def __init__(self, main: 'WesSession', log, eventsDir="user_events") -> None:
         self.main = main
         self.log = log
         self.lastUpdate = datetime.datetime.now()
+        # Each session has its own events, saved to files in eventsDir
+        self.eventsDir = eventsDir
+        self.connectTimes = [0]
+        self.userEvents = WeakList()
+        self.userEventsView = defaultdict(list)
 
     def addConnectTime(self) -> None:
         if self.connectTimes[0] < 0.0001:
@@ -384,7 +415,7 @@ class StatsHolder:
         for name in self.userEventsView:
             unsavedSince = 0
 
-            filename = "user_events/{}/{}.log".format(name, name)
+            filename = "{}/{}/{}.log".format(self.eventsDir, name, name)
             os.makedirs(os.path.dirname(filename), exist_ok=True)
             if os.path.isfile(filename):
                 with open(filename, "r", encoding="utf8") as f:
@@ -403,7 +434,7 @@ class StatsHolder:
         self.main.log.debug("Users saved")
 
     def loadUserEvents(self, name):
-        filename = "user_events/{}/{}.log".format(name, name)
+        filename = "{}/{}/{}.log".format(self.eventsDir, name, name)
         if not os.path.isfile(filename):
             return
         self.log.debug("Loading user events for {}".format(name))
@@ -434,11 +465,11 @@ class LobbyHolder:
     games: GameHolder
     stats: StatsHolder
 
-    def __init__(self, main: 'WesBot', statsLog: 'Logger'):
+    def __init__(self, main: 'WesSession', statsLog: 'Logger', eventsDir="user_events"):
         self.main = main
         self.users = UserHolder(main, self)
         self.games = GameHolder(main, self)
-        self.stats = StatsHolder(main, statsLog)
+        self.stats = StatsHolder(main, statsLog, eventsDir)
 
     def reset(self):
         self.stats.onQuit()
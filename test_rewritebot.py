@@ -0,0 +1,237 @@
+"""
+Tests of the bot that need no server, run with python3 -m unittest test_rewritebot
+"""
+import asyncio
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+
+import rewritebot
+from rewritebotCAP import CaptureWriter
+from rewritebotCFG import WesSettings
+from rewritebotCMD import PERMISSION_ADMIN
+from rewritebotCON import WesSock
+from rewritebotIRC import WesIrc
+from rewritebotSCHEMA import WesException
+
+cwd = None
+
+
+def setUpModule():
+    # The bot writes its logs to log/ in the working directory
+    global cwd
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    os.mkdir("log")
+    # Not in the published rewritebotCFG
+    WesSettings.botIrcMasterNames = ["Rav"]
+    WesSettings.botTrustedNames = []
+
+
+def tearDownModule():
+    directory = os.getcwd()
+    os.chdir(cwd)
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+class FakeIrc:
+    """
+    Records what the bot says on IRC.
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def say(self, msg: str):
+        self.lines.append(msg)
+
+    def whisper(self, target: str, msg: str):
+        self.lines.append("{}: {}".format(target, msg))
+
+
+class DisconnectedTest(unittest.TestCase):
+    """
+    Commands from IRC while the session waits to reconnect, without a WesSock.
+    """
+
+    def setUp(self):
+        self.bot = rewritebot.WesBot()
+        self.irc = self.bot.commandHandler.irc = FakeIrc()
+
+    def command(self, message: str):
+        self.bot.commandHandler.onMessage("!" + message, "Rav", PERMISSION_ADMIN + 5, "irc", True)
+        return self.irc.lines[-1]
+
+    def test_stats(self):
+        self.assertEqual(self.command("stats"), "Rav: main is not connected")
+
+    def test_whisper(self):
+        self.assertEqual(self.command("m someone hi"), "Rav: main is not connected")
+
+    def test_say(self):
+        self.bot.commandHandler.sayOnWesnoth("hi")
+        self.assertEqual(self.irc.lines, ["->: hi"])
+
+    def test_sessions(self):
+        self.assertEqual(self.command("sessions"), "Rav: main: not connected")
+
+
+class SessionStopTest(unittest.TestCase):
+    """
+    A session's own errors are handled by the session, others stop mainLoop.
+    """
+
+    def setUp(self):
+        self.bot = rewritebot.WesBot()
+        self.bot.loop = asyncio.new_event_loop()
+        self.bot.stopped = self.bot.loop.create_future()
+        self.session = self.bot.sessions[0]
+
+    def tearDown(self):
+        self.bot.loop.close()
+        WesSettings.wesEnabled = True
+
+    def test_reconnect(self):
+        self.session.stop(WesException("wesreconnect command used").reconnectWes())
+        self.assertFalse(self.bot.stopped.done())
+        self.assertTrue(self.session.enabled)
+        self.assertEqual(self.session.failures, 1)
+
+    def test_quit(self):
+        self.session.stop(WesException("wes connection lost").addAction(WesException.QUIT_WES))
+        self.assertFalse(self.bot.stopped.done())
+        self.assertFalse(self.session.enabled)
+
+    def test_tick(self):
+        def tick():
+            raise WesException("no games").reconnectWes()
+
+        self.session.wesSock = WesSock(self.session, self.session.cfg.wesnothVersion)
+        self.session.lobby.stats.tick = tick
+        self.session.tick()
+        self.assertIsNone(self.session.wesSock)
+        self.assertFalse(self.bot.stopped.done())
+
+    def test_other(self):
+        e = WesException("Did not manage to join lobby").addAction(WesException.FATAL)
+        self.session.stop(e)
+        self.assertIs(self.bot.stopped.exception(), e)
+
+
+class ReconnectTest(unittest.TestCase):
+    """
+    A session whose connect fails while mainLoop is run again.
+    """
+
+    def setUp(self):
+        self.bot = rewritebot.WesBot()
+        self.bot.cfg.ircEnabled = False
+        self.bot.cfg.wesReconnectDelay = 10
+        self.bot.loop = asyncio.new_event_loop()
+        self.session = self.bot.sessions[0]
+        self.attempts = 0
+
+        async def connect(loop):
+            self.attempts += 1
+            raise WesException("could not connect session main").reconnectWes()
+
+        self.session.connect = connect
+
+    def tearDown(self):
+        for task in self.attaching():
+            task.cancel()
+        self.bot.loop.run_until_complete(asyncio.sleep(0))
+        self.bot.loop.close()
+        self.bot.cfg.ircEnabled = True
+        self.bot.cfg.wesReconnectDelay = WesSettings.__dict__["wesReconnectDelay"]
+
+    def attaching(self):
+        return [task for task in asyncio.all_tasks(self.bot.loop)
+                if not task.done() and task.get_coro().__qualname__ == "WesSession.attach"]
+
+    def serve(self):
+        async def serveBriefly(loop):
+            serving = loop.create_task(self.bot.serve(loop))
+            await asyncio.sleep(0.1)
+            self.bot.stopped.set_result(None)
+            await serving
+
+        self.bot.loop.run_until_complete(serveBriefly(self.bot.loop))
+
+    def test_one_attempt(self):
+        self.serve()
+        # At once, then again after a failure, the third waits for wesReconnectDelay
+        self.assertEqual(self.attempts, 2)
+        self.assertEqual(self.attaching(), [self.session.connecting])
+        self.serve()
+        self.assertEqual(self.attempts, 2)
+        self.assertEqual(len(self.attaching()), 1)
+
+
+class IrcShutdownTest(unittest.TestCase):
+    def test_queued(self):
+        """the lines still waiting for the rate are sent before closing"""
+        bot = rewritebot.WesBot()
+        bot.loop = asyncio.new_event_loop()
+        bot.stopped = bot.loop.create_future()
+        server, client = socket.socketpair()
+        bot.irc = WesIrc(bot)
+        bot.irc.sock.close()
+        bot.irc.sock = client
+        bot.irc.connected = True
+        bot.loop.run_until_complete(bot.irc.attach(bot.loop))
+        for i in range(20):
+            bot.irc.say("line {}".format(i))
+        bot.cleanupIrc()
+        received = b""
+        server.settimeout(1)
+        chunk = server.recv(65536)
+        while chunk:
+            received += chunk
+            chunk = server.recv(65536)
+        server.close()
+        bot.loop.close()
+        self.assertEqual(received.count(b"PRIVMSG"), 20)
+        self.assertTrue(received.endswith(b"line 19\r\n"))
+
+
+class CaptureTest(unittest.TestCase):
+    def test_failed(self):
+        """close does not block when writing the capture failed"""
+        writer = CaptureWriter("missing/wesbot_rec.cap", 1 << 20, 2)
+        for i in range(2 * CaptureWriter.MAX_QUEUED):
+            writer.write(b"frame")
+        writer.close()
+        writer.thread.join(5)
+        self.assertFalse(writer.thread.is_alive())
+        self.assertIsInstance(writer.error, OSError)
+        self.assertIn("failed", writer.getStats())
+
+
+class MainTest(unittest.TestCase):
+    def test_errors(self):
+        """main runs mainLoop again after each error, without recursing"""
+        bot = rewritebot.WesBot()
+        bot.cfg.ircEnabled = False
+        runs = []
+
+        def mainLoop():
+            runs.append(1)
+            if len(runs) > sys.getrecursionlimit():
+                raise WesException("quit command used").quit()
+            raise WesException("not found").addAction(WesException.ASSERT)
+
+        bot.mainLoop = mainLoop
+        try:
+            with self.assertRaises(SystemExit):
+                bot.main()
+        finally:
+            bot.cfg.ircEnabled = True
+        self.assertEqual(len(runs), sys.getrecursionlimit() + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
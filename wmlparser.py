@@ -43,11 +43,67 @@ The get_name method can be used to get the name and the get_text_val
 method can be used to query the value of an attribute.
 """
 
-import os, glob, sys, re, subprocess, argparse, tempfile, shutil
+import os, glob, sys, re, subprocess, argparse, tempfile, shutil, io
+import hashlib
+import textwrap
+import traceback
 import atexit
 
 tempdirs_to_clean = []
 
+# Marks the start of a parser command (like "line" or "textdomain") in
+# the .plain output of wesnoth --preprocess.
+COMMAND_MARKER = bytes([254])
+
+# The parsing engines a Parser can use, see Parser.engine.
+ENGINES = ("lines", "buffer")
+
+# Finds the first character bytes.strip would keep.
+NON_SPACE = re.compile(rb"\S")
+
+# A whole line holding just a [tag], [/tag] or key="value", which the
+# buffer engine handles directly. Lines using anything else (multiple
+# keys, translatable or concatenated values, multi-line strings, <<>>,
+# parser commands) are left to the general tokenizer.
+SIMPLE_LINE = re.compile(
+    rb'[ \t]*(?:\[(/?)([^\]\n"<\xfe]*)\]'
+    rb'|([^\s=,"\[#<+\xfe]+)[ \t]*=[ \t]*"((?:[^"\n\xfe]|"")*)")'
+    rb'[ \t\r]*\n')
+
+# Values at least this long are not copied out of the input by the
+# buffer engine, their StringNode references the input buffer instead.
+ZERO_COPY_MIN = 1024
+
+# Returned by WMLHandler.start to make the PushParser skip the contents
+# of the tag.
+SKIP = object()
+
+# Tag and attribute names seen so far, so that all nodes of the same name
+# share one bytes object. Bounded since arbitrary WML may use any names.
+interned_names = {}
+MAX_INTERNED_NAMES = 10000
+
+
+def intern_name(name: bytes) -> bytes:
+    """
+    Returns the shared bytes object equal to name.
+    """
+    shared = interned_names.get(name)
+    if shared is not None:
+        return shared
+    if len(interned_names) < MAX_INTERNED_NAMES:
+        interned_names[name] = name
+    return name
+
+
+def hash_file(sha, path):
+    """
+    Updates the hash object sha with the content of the file at path.
+    """
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            sha.update(block)
+
 
 @atexit.register
 def cleaner():
@@ -76,28 +132,58 @@ class WMLError(Exception):
 """ % (str(self.line), self.preprocessed, self.wml_line, self.message)
 
 
+class WMLDiffError(Exception):
+    """
+    Raised by apply_diff when a diff does not fit the tree it is
+    applied to.
+    """
+
+
 class StringNode:
     """
     One part of an attribute's value. Because a single WML string
     can be made from multiple translatable strings we model
     it as a list of several StringNode each with its own text domain.
+
+    The value may be given as a memoryview into the parsed input, which
+    is only copied if data is asked for. The decoded text is kept after
+    the first get_text.
     """
+    __slots__ = ("textdomain", "raw", "text")
 
-    def __init__(self, data: bytes):
+    def __init__(self, data):
         self.textdomain = None  # non-translatable by default
-        self.data = data
+        self.raw = data
+        self.text = None
+
+    @property
+    def data(self) -> bytes:
+        raw = self.raw
+        if type(raw) is memoryview:
+            # Copy it once, which also releases the input buffer.
+            raw = self.raw = raw.tobytes()
+        return raw
+
+    @data.setter
+    def data(self, data):
+        self.raw = data
+        self.text = None
+
+    def get_text(self) -> str:
+        if self.text is None:
+            self.text = str(self.raw, "utf8", "ignore")
+        return self.text
 
     def wml(self) -> bytes:
-        if not self.data:
+        if not self.raw:
             return b""
         return self.data
 
     def debug(self):
         if self.textdomain:
-            return "_<%s>'%s'" % (self.textdomain,
-                                  self.data.decode("utf8", "ignore"))
+            return "_<%s>'%s'" % (self.textdomain, self.get_text())
         else:
-            return "'%s'" % self.data.decode("utf8", "ignore")
+            return "'%s'" % self.get_text()
 
 
 class AttributeNode:
@@ -108,6 +194,8 @@ class AttributeNode:
         [/unit]
     """
 
+    __slots__ = ("name", "location", "value")
+
     def __str__(self) -> str:
         return "AttributeNode({})".format(self.get_name())
 
@@ -117,11 +205,9 @@ class AttributeNode:
         self.value = []  # List of StringNode
 
     def wml(self) -> bytes:
-        s = self.name + b"=\""
-        for v in self.value:
-            s += v.wml().replace(b"\"", b"\"\"")
-        s += b"\""
-        return s
+        return b"".join([self.name, b"=\""] +
+                        [v.wml().replace(b"\"", b"\"\"") for v in self.value] +
+                        [b"\""])
 
     def debug(self):
         return self.name.decode("utf8") + "=" + " .. ".join(
@@ -134,9 +220,11 @@ class AttributeNode:
         partial string with the string and its corresponding textdomain
         and the returned translation will be used.
         """
+        if len(self.value) == 1 and not translation:
+            return self.value[0].get_text()
         r = ""
         for s in self.value:
-            ustr = s.data.decode("utf8", "ignore")
+            ustr = s.get_text()
             if translation:
                 r += translation(ustr, s.textdomain)
             else:
@@ -147,6 +235,8 @@ class AttributeNode:
         """
         Returns the unmodified binary representation of the value.
         """
+        if len(self.value) == 1:
+            return self.value[0].data
         r = b""
         for s in self.value:
             r += s.data
@@ -164,6 +254,9 @@ class TagNode:
         [/unit]
     """
 
+    __slots__ = ("name", "location", "data", "speedy_tags", "speedy_atts",
+                 "speedy_values")
+
     def __str__(self) -> str:
         return "TagNode({})".format(self.get_name())
 
@@ -174,7 +267,12 @@ class TagNode:
         # AttributeNode.
         self.data = []
 
+        # Child tags and attributes by name, kept up to date by append.
         self.speedy_tags = {}
+        self.speedy_atts = {}
+        # Built on demand by value_index: its indexes, and the tags whose
+        # indexes include this one, see changed.
+        self.speedy_values = None
 
     def wml(self) -> bytes:
         """
@@ -184,11 +282,9 @@ class TagNode:
         performed (see the BinaryWML specification for additional
         escaping you may require).
         """
-        s = b"[" + self.name + b"]\n"
-        for sub in self.data:
-            s += sub.wml() + b"\n"
-        s += b"[/" + self.name + b"]\n"
-        return s
+        writer = WMLWriter()
+        writer.node(self)
+        return writer.getvalue()
 
     def debug(self):
         s = "[%s]\n" % self.name.decode("utf8")
@@ -231,6 +327,8 @@ class TagNode:
         """
         if len(kw) == 1 and "tag" in kw and kw["tag"]:
             return self.speedy_tags.get(kw["tag"].encode("utf8"), [])
+        if len(kw) == 1 and "att" in kw and kw["att"]:
+            return self.speedy_atts.get(kw["att"].encode("utf8"), [])
 
         r = []
         for sub in self.data:
@@ -264,7 +362,7 @@ class TagNode:
         it to gettext.translation if you have the binary message
         catalogues loaded.
         """
-        x = self.get_all(att=name)
+        x = self.speedy_atts.get(name.encode("utf8"))
         if not x: return default
         return x[val].get_text(translation)
 
@@ -274,7 +372,7 @@ class TagNode:
         of the given name or the passed default value if it is not
         found.
         """
-        x = self.get_all(att=name)
+        x = self.speedy_atts.get(name.encode("utf8"))
         if not x: return default
         return x[0].get_binary()
 
@@ -283,25 +381,141 @@ class TagNode:
         Appends a child node (must be either a TagNode or
         AttributeNode).
         """
+        if self.speedy_values is not None:
+            self.changed()
         self.data.append(node)
 
         if isinstance(node, TagNode):
             if node.name not in self.speedy_tags:
                 self.speedy_tags[node.name] = []
             self.speedy_tags[node.name].append(node)
+        else:
+            if node.name not in self.speedy_atts:
+                self.speedy_atts[node.name] = []
+            self.speedy_atts[node.name].append(node)
+
+    def select(self, path):
+        """
+        Returns an iterator over the tags below this one matching path,
+        or over the attribute values if it ends with @name:
+
+        lobby.select("gamelist/game[observer=yes]/slot_data/@vacant")
+
+        See Selector for the syntax. The path is compiled once and the
+        matches are found while iterating.
+        """
+        return compile_path(path).select(self)
+
+    def first(self, path, default=None):
+        """
+        Returns the first match of select(path), or default.
+        """
+        return next(compile_path(path).select(self), default)
+
+    def value_index(self, name, att):
+        """
+        Returns a dict from each value of the att attribute to the
+        child tags called name having it (using the last value like
+        get_text_val). Names are bytes. The dict is built on the first
+        call and reused until this tag or one of those children changes.
+        """
+        values = self.speedy_values
+        if values is None:
+            values = self.speedy_values = ({}, [])
+        index = values[0].get((name, att))
+        if index is None:
+            index = values[0][name, att] = {}
+            for sub in self.speedy_tags.get(name, ()):
+                # So that a change to sub drops the index
+                if sub.speedy_values is None:
+                    sub.speedy_values = ({}, [self])
+                elif self not in sub.speedy_values[1]:
+                    sub.speedy_values[1].append(self)
+                atts = sub.speedy_atts.get(att)
+                if atts:
+                    index.setdefault(atts[-1].get_text(), []).append(sub)
+        return index
+
+    def changed(self):
+        """
+        Drops the indexes of this tag, and of the tags whose indexes
+        include it. Called by the methods changing the tag.
+        """
+        values = self.speedy_values
+        if values is not None:
+            self.speedy_values = None
+            for parent in values[1]:
+                parent.changed()
 
     def get_name(self):
         return self.name.decode("utf8")
 
+    def describe(self):
+        return "[%s]" % self.get_name()
+
+    # The DiffTarget methods, so that apply_diff can change the tree.
+
+    def set_attribute(self, attribute):
+        """
+        Replaces the attributes of the same name with attribute.
+        """
+        self.changed()
+        old = self.speedy_atts.get(attribute.name)
+        if not old:
+            self.append(attribute)
+            return
+        position = self.data.index(old[0])
+        for node in old[1:]:
+            self.data.remove(node)
+        self.data[position] = attribute
+        self.speedy_atts[attribute.name] = [attribute]
+
+    def delete_attribute(self, name):
+        self.changed()
+        for node in self.speedy_atts.pop(name, ()):
+            self.data.remove(node)
+
+    def child(self, name, index):
+        same = self.speedy_tags.get(name)
+        if not same or index >= len(same):
+            raise WMLDiffError("No [%s] number %d in %s" % (
+                name.decode("utf8"), index, self.describe()))
+        return same[index]
+
+    def insert_child(self, name, index, node):
+        same = self.speedy_tags.get(name, [])
+        if index > len(same):
+            raise WMLDiffError("Cannot insert [%s] number %d into %s" % (
+                name.decode("utf8"), index, self.describe()))
+        if index == len(same):
+            self.append(node)
+            return
+        self.changed()
+        self.data.insert(self.data.index(same[index]), node)
+        same.insert(index, node)
+
+    def delete_child(self, name, index):
+        node = self.child(name, index)
+        self.changed()
+        same = self.speedy_tags[name]
+        del same[index]
+        if not same:
+            del self.speedy_tags[name]
+        self.data.remove(node)
+
 
 class RootNode(TagNode):
     """
     The root node. There is exactly one such node.
     """
+    __slots__ = ()
 
     def __init__(self):
         TagNode.__init__(self, None)
 
+    def describe(self):
+        return "the root"
+
     def debug(self):
         s = ""
         for sub in self.data:
@@ -310,6 +524,277 @@ class RootNode(TagNode):
         return s
 
 
+class DiffTarget:
+    """
+    What apply_diff changes. The methods do nothing, so a subclass only
+    needs those for the parts of the tree it mirrors. Names are bytes,
+    attributes and inserted children are the nodes from the diff. A
+    TagNode is a DiffTarget for the tree below it.
+    """
+
+    def set_attribute(self, attribute):
+        """
+        Called for every AttributeNode in an [insert].
+        """
+
+    def delete_attribute(self, name):
+        """
+        Called for every attribute name in a [delete].
+        """
+
+    def child(self, name, index):
+        """
+        Returns the DiffTarget for the index-th child tag called name,
+        which a [change_child] applies its diff to.
+        """
+        return DiffTarget()
+
+    def insert_child(self, name, index, node):
+        """
+        Inserts the TagNode node as the index-th child called name.
+        """
+
+    def delete_child(self, name, index):
+        """
+        Removes the index-th child tag called name.
+        """
+
+
+def diff_index(node):
+    index = node.get_text_val("index")
+    try:
+        return int(index)
+    except (TypeError, ValueError):
+        raise WMLDiffError("Bad index=%s in [%s]" % (index, node.get_name()))
+
+
+def apply_diff(target, diff):
+    """
+    Applies a Wesnoth style diff, like the contents of [gamelist_diff],
+    to target, a TagNode or DiffTarget. As in the game the parts are
+    applied in the order [insert], [delete], [change_child],
+    [insert_child] and then [delete_child], each going over the diff's
+    children once. The index of a child operation counts only children
+    with the same name, and children inserted before it in the same
+    diff.
+    """
+    tags = diff.speedy_tags
+    for insert in tags.get(b"insert", ()):
+        for attribute in insert.data:
+            if isinstance(attribute, AttributeNode):
+                target.set_attribute(attribute)
+    for delete in tags.get(b"delete", ()):
+        for attribute in delete.data:
+            if isinstance(attribute, AttributeNode):
+                target.delete_attribute(attribute.name)
+    for change in tags.get(b"change_child", ()):
+        index = diff_index(change)
+        for item in change.data:
+            if isinstance(item, TagNode):
+                apply_diff(target.child(item.name, index), item)
+    for insert in tags.get(b"insert_child", ()):
+        index = diff_index(insert)
+        for item in insert.data:
+            if isinstance(item, TagNode):
+                target.insert_child(item.name, index, item)
+    for delete in tags.get(b"delete_child", ()):
+        index = diff_index(delete)
+        for item in delete.data:
+            if isinstance(item, TagNode):
+                target.delete_child(item.name, index)
+
+
+# One step of a Selector path: a name or * and any [predicates].
+PATH_STEP = re.compile(r"(\*|\w+)((?:\[[^\[\]]*\])*)\Z")
+PATH_PREDICATE = re.compile(r"\[(?:(\d+)|(\w+)(?:=([^\[\]]*))?)\]\Z")
+
+# Selectors by path, for TagNode.select. Cleared when full.
+compiled_paths = {}
+MAX_COMPILED_PATHS = 1000
+
+
+def compile_path(path):
+    """
+    Returns the Selector for path, compiling it only the first time.
+    """
+    selector = compiled_paths.get(path)
+    if selector is None:
+        selector = Selector(path)
+        if len(compiled_paths) >= MAX_COMPILED_PATHS:
+            compiled_paths.clear()
+        compiled_paths[path] = selector
+    return selector
+
+
+class Selector:
+    """
+    A compiled path to tags below a TagNode. The path is a list of
+    steps separated by /, each the name of a child tag or * for any
+    child tag, optionally followed by predicates:
+
+        [att=value]  only tags whose att attribute is value
+        [att]        only tags having an att attribute
+        [N]          only the N-th tag (from 0) of those matched so far
+
+    The path may end with @att, which selects the text of that
+    attribute of the matched tags instead (tags without it are left
+    out). A leading [att=value] on a named step is looked up in the
+    parent's value_index instead of comparing every child.
+
+    Raises ValueError for a malformed path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        steps = path.split("/")
+        self.attribute = None
+        if steps[-1].startswith("@"):
+            att = steps.pop()[1:]
+            if not re.match(r"\w+\Z", att):
+                raise ValueError("Bad attribute in path %r" % path)
+            self.attribute = att.encode("utf8")
+        self.steps = [self.compile_step(step) for step in steps]
+
+    def compile_step(self, step):
+        m = PATH_STEP.match(step)
+        if not m:
+            raise ValueError("Bad step %r in path %r" % (step, self.path))
+        name = None if m.group(1) == "*" else m.group(1).encode("utf8")
+        predicates = []
+        for predicate in re.findall(r"\[[^\]]*\]", m.group(2)):
+            p = PATH_PREDICATE.match(predicate)
+            if not p:
+                raise ValueError("Bad predicate %s in path %r" % (predicate, self.path))
+            index, att, value = p.groups()
+            if index:
+                predicates.append((int(index), None, None))
+            else:
+                predicates.append((None, att.encode("utf8"), value))
+        key = None
+        if name is not None and predicates and predicates[0][2] is not None:
+            key = predicates.pop(0)[1:]
+        return name, key, predicates
+
+    def __repr__(self):
+        return "Selector(%r)" % self.path
+
+    def select(self, node):
+        """
+        Returns an iterator over the matches below node.
+        """
+        nodes = iter((node,))
+        for step in self.steps:
+            nodes = self.walk(nodes, step)
+        if self.attribute is not None:
+            return self.texts(nodes)
+        return nodes
+
+    def walk(self, nodes, step):
+        name, key, predicates = step
+        for node in nodes:
+            if key is not None:
+                found = node.value_index(name, key[0]).get(key[1], ())
+            elif name is None:
+                found = [sub for sub in node.data if isinstance(sub, TagNode)]
+            else:
+                found = node.speedy_tags.get(name, ())
+            for index, att, value in predicates:
+                if index is not None:
+                    found = found[index:index + 1]
+                elif value is None:
+                    found = [tag for tag in found if att in tag.speedy_atts]
+                else:
+                    found = [tag for tag in found
+                             if att in tag.speedy_atts and
+                             tag.speedy_atts[att][-1].get_text() == value]
+            yield from found
+
+    def texts(self, nodes):
+        att = self.attribute
+        for node in nodes:
+            atts = node.speedy_atts.get(att)
+            if atts:
+                yield atts[-1].get_text()
+
+class WMLWriter:
+    """
+    Writes WML to a binary file-like sink (a BytesIO by default) in a
+    single pass, without building intermediate strings:
+
+        w = WMLWriter()
+        w.tag("whisper", message="hi", receiver="Elve", sender="Bot")
+        data = w.getvalue()
+        w.reset()
+
+    Names and values may be given as str (encoded as UTF-8), bytes or
+    any other object (converted with str). Values are always quoted,
+    quotes inside them are doubled.
+    """
+
+    def __init__(self, sink=None):
+        if sink is None:
+            sink = io.BytesIO()
+        self.sink = sink
+        self.write = sink.write
+
+    @staticmethod
+    def to_bytes(x) -> bytes:
+        if isinstance(x, bytes):
+            return x
+        if not isinstance(x, str):
+            x = str(x)
+        return x.encode("utf8")
+
+    def open_tag(self, name):
+        self.write(b"[" + self.to_bytes(name) + b"]\n")
+
+    def close_tag(self, name):
+        self.write(b"[/" + self.to_bytes(name) + b"]\n")
+
+    def attribute(self, name, value):
+        self.write(b"%s=\"%s\"\n" % (self.to_bytes(name),
+                                     self.to_bytes(value).replace(b"\"", b"\"\"")))
+
+    def tag(self, tag_name, **attributes) -> "WMLWriter":
+        """
+        Writes a tag containing the given attributes, in the given
+        order.
+        """
+        self.open_tag(tag_name)
+        for key, value in attributes.items():
+            self.attribute(key, value)
+        self.close_tag(tag_name)
+        return self
+
+    def node(self, node):
+        """
+        Writes a TagNode (or RootNode) with all its children, or a
+        single AttributeNode.
+        """
+        if isinstance(node, AttributeNode):
+            self.write(node.wml() + b"\n")
+            return
+        if node.name is not None:
+            self.open_tag(node.name)
+        for sub in node.data:
+            self.node(sub)
+        if node.name is not None:
+            self.close_tag(node.name)
+
+    def getvalue(self) -> bytes:
+        """
+        Returns everything written so far, if the sink is a BytesIO.
+        """
+        return self.sink.getvalue()
+
+    def reset(self):
+        """
+        Empties the sink so that the writer can be reused.
+        """
+        self.sink.seek(0)
+        self.sink.truncate()
+
+
 class Parser:
     def __init__(self, wesnoth_exe=None, config_dir=None,
                  data_dir=None):
@@ -334,6 +819,21 @@ class Parser:
         self.no_preprocess = (wesnoth_exe == None)
         self.preprocessed = None
         self.verbose = False
+        # Whether nodes remember where in the input they were found, for
+        # network payloads this can be turned off to save memory.
+        self.track_locations = True
+        # "lines" tokenizes the input line by line, slicing off what has
+        # been handled. "buffer" reads the whole input and tokenizes it
+        # by offsets into that one buffer. Both build the same tree.
+        self.engine = "lines"
+        # If set, preprocessed output is kept in this directory, keyed by
+        # the input, defines and wesnoth executable, and reused instead
+        # of running wesnoth --preprocess again. Files included from
+        # elsewhere are not part of the key, so the cache must be cleared
+        # when those change. Once it holds more than cache_size bytes
+        # the least recently used entries are removed.
+        self.cache_dir = None
+        self.cache_size = 256 * 1024 * 1024
 
         self.last_wml_line = "?"
         self.parser_line = 0
@@ -351,16 +851,27 @@ class Parser:
 
     def parse_binary(self, binary: bytes, defines="") -> RootNode:
         """
-        Parse a chunk of binary WML.
+        Parse a chunk of binary WML. Any bytes-like object (bytes,
+        bytearray, memoryview) is accepted. Without preprocessing the
+        chunk is parsed straight from memory, otherwise it is written
+        to a temporary file for wesnoth --preprocess which is removed
+        again afterwards.
         """
+        if self.no_preprocess:
+            self.path = None
+            self.preprocessed = None
+            return self.parse(io.BytesIO(binary))
+
         temp = tempfile.NamedTemporaryFile(prefix="wmlparser_",
                                            suffix=".cfg", delete=False)
-        temp.write(binary)
-        temp.flush()
-        self.path = temp.name
-        if not self.no_preprocess:
-            self.preprocess(defines)
-        return self.parse()
+        try:
+            with temp:
+                temp.write(binary)
+            self.path = temp.name
+            self.preprocess(defines, anonymous=True)
+            return self.parse()
+        finally:
+            os.remove(temp.name)
 
     def parse_text(self, text, defines="") -> RootNode:
         """
@@ -368,12 +879,25 @@ class Parser:
         """
         return self.parse_binary(text.encode("utf8"), defines)
 
-    def preprocess(self, defines):
+    def preprocess(self, defines, anonymous=False):
         """
         This is called by the parse functions to preprocess the
         input from a normal WML .cfg file into a preprocessed
-        .plain file.
+        .plain file. anonymous means the input is a temporary copy,
+        whose name and location do not matter for caching.
         """
+        if self.cache_dir:
+            key = self.preprocess_key(defines, anonymous)
+            cached = os.path.join(self.cache_dir, key + ".plain")
+            if os.path.exists(cached):
+                if self.verbose:
+                    print(("using cached " + cached))
+                # Mark it as recently used for evict_cache.
+                os.utime(cached)
+                self.temp_dir = None
+                self.preprocessed = cached
+                return
+
         if self.keep_temp_dir:
             output = self.keep_temp_dir
         else:
@@ -406,6 +930,82 @@ class Parser:
                            out.decode("utf8") +
                            err.decode("utf8"))
 
+        if self.cache_dir:
+            self.store_in_cache(key)
+
+    def preprocess_key(self, defines, anonymous=False) -> str:
+        """
+        Returns the cache key for preprocessing self.path with the given
+        defines: a hash of the input's content (every file in it if it
+        is a directory) and location, the defines, the data and config
+        directories and the identity of the wesnoth executable.
+        """
+        sha = hashlib.sha256()
+        exe = os.path.realpath(self.wesnoth_exe)
+        st = os.stat(exe)
+        location = "" if anonymous else os.path.realpath(self.path)
+        for part in [exe, str(st.st_mtime_ns), str(st.st_size),
+                     self.data_dir or "", self.config_dir or "",
+                     defines or "", location]:
+            sha.update(part.encode("utf8") + b"\0")
+        if os.path.isdir(self.path):
+            for dirpath, dirnames, filenames in os.walk(self.path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    filepath = os.path.join(dirpath, filename)
+                    relpath = os.path.relpath(filepath, self.path)
+                    sha.update(relpath.encode("utf8") + b"\0")
+                    hash_file(sha, filepath)
+        else:
+            hash_file(sha, self.path)
+        return sha.hexdigest()
+
+    def store_in_cache(self, key):
+        """
+        Copies the preprocessed output into the cache under key. It is
+        written to a temporary name first so that a parser using the
+        same cache never reads a partial file.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, temp = tempfile.mkstemp(prefix="wmlparser_", suffix=".tmp",
+                                    dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as f, \
+                    open(self.preprocessed, "rb") as plain:
+                shutil.copyfileobj(plain, f)
+            os.replace(temp, os.path.join(self.cache_dir, key + ".plain"))
+        except OSError:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        self.evict_cache()
+
+    def evict_cache(self):
+        """
+        Removes the least recently used entries from the cache until it
+        holds at most cache_size bytes.
+        """
+        entries = []
+        total = 0
+        for path in glob.glob(os.path.join(self.cache_dir, "*.plain")):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, path, st.st_size))
+            total += st.st_size
+        entries.sort()
+        for mtime, path, size in entries:
+            if total <= self.cache_size:
+                break
+            if self.verbose:
+                print(("evicting " + path))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
     def parse_line_without_commands_loop(self, line: str) -> str:
         """
         Once the .plain commands are handled WML lines are passed to
@@ -480,6 +1080,93 @@ class Parser:
             if not line:
                 break
 
+    def scan(self, buf, pos, end):
+        """
+        The buffer engine's parse_line_without_commands, for the line
+        (without commands) found at buf[pos:end].
+        """
+        while pos < end:
+            pos = self.scan_once(buf, pos, end)
+
+    def scan_once(self, buf, pos, end) -> int:
+        """
+        The buffer engine's parse_line_without_commands_loop. Instead
+        of the unhandled rest of the line it returns the offset where
+        it starts.
+        """
+        if NON_SPACE.search(buf, pos, end):
+            self.skip_newlines_after_plus = False
+
+        if self.in_string and self.string_buf is not buf:
+            # The string continues here, after a command or in the next
+            # buffer fed to a PushParser.
+            self.string_buf = buf
+            self.string_start = pos
+
+        if self.in_tag:
+            self.handle_tag(buf[pos:end])
+            return end
+
+        if self.in_arrows:
+            arrows = buf.find(b'>>', pos, end)
+            if arrows >= 0:
+                self.temp_string += buf[pos:arrows]
+                self.temp_string_node = StringNode(self.temp_string)
+                self.temp_string = b""
+                self.temp_key_nodes[self.commas].value.append(
+                    self.temp_string_node)
+                self.in_arrows = False
+                return arrows + 2
+            self.temp_string += buf[pos:end]
+            return end
+
+        quote = buf.find(b'"', pos, end)
+
+        if not self.in_string:
+            arrows = buf.find(b'<<', pos, end)
+            if arrows >= 0 and (quote < 0 or quote > arrows):
+                self.scan(buf, pos, arrows)
+                self.in_arrows = True
+                return arrows + 2
+
+        # Strings are not copied while scanning them, only string_start
+        # is remembered, unless they are interrupted (see flush_string).
+        if quote < 0:
+            if not self.in_string:
+                self.parse_outside_strings(buf[pos:end])
+            return end
+
+        if not self.in_string:
+            self.parse_outside_strings(buf[pos:quote])
+            self.in_string = True
+            self.string_buf = buf
+            self.string_start = quote + 1
+            return quote + 1
+
+        # double quote
+        if quote < end - 1 and buf[quote + 1] == 34:
+            self.temp_string += buf[self.string_start:quote + 1]
+            self.string_start = quote + 2
+            return quote + 2
+        if self.temp_string or quote - self.string_start < ZERO_COPY_MIN:
+            value = self.temp_string + buf[self.string_start:quote]
+        else:
+            value = memoryview(buf)[self.string_start:quote]
+        self.string_buf = None
+        self.temp_string_node = StringNode(value)
+        if self.translatable:
+            self.temp_string_node.textdomain = self.textdomain
+            self.translatable = False
+        self.temp_string = b""
+        if not self.temp_key_nodes:
+            raise WMLError(self, "Unexpected string value.")
+
+        self.temp_key_nodes[self.commas].value.append(
+            self.temp_string_node)
+
+        self.in_string = False
+        return quote + 1
+
     def parse_outside_strings(self, line):
         """
         Parse a WML fragment outside of strings.
@@ -526,14 +1213,43 @@ class Parser:
         tag = (self.in_tag + line[:end])[1:]
         self.in_tag = b""
         if tag.startswith(b"/"):
-            self.parent_node = self.parent_node[:-1]
+            self.close_tag(tag[1:])
         else:
-            node = TagNode(tag, location=(self.line_in_file, self.chunk_start))
-            if self.parent_node:
-                self.parent_node[-1].append(node)
-            self.parent_node.append(node)
+            self.open_tag(tag)
         self.parse_outside_strings(line[end + 1:])
 
+    def open_tag(self, name):
+        """
+        Called for every opening [tag]. Builds the tree; subclasses
+        may override this (together with close_tag and add_attribute)
+        to process the WML in a different way.
+        """
+        node = TagNode(intern_name(name), location=self.location())
+        if self.parent_node:
+            self.parent_node[-1].append(node)
+        self.parent_node.append(node)
+
+    def close_tag(self, name):
+        """
+        Called for every closing [/tag].
+        """
+        self.parent_node = self.parent_node[:-1]
+
+    def add_attribute(self, node):
+        """
+        Called for every new attribute, before its value is parsed.
+        """
+        if self.parent_node:
+            self.parent_node[-1].append(node)
+
+    def location(self):
+        """
+        The location to store in a new node, if locations are tracked.
+        """
+        if self.track_locations:
+            return self.line_in_file, self.chunk_start
+        return None
+
     def handle_attribute(self, line):
         assign = line.find(b"=")
         remainder = None
@@ -545,10 +1261,9 @@ class Parser:
         self.temp_key_nodes = []
         for att in line.split(b","):
             att = att.strip()
-            node = AttributeNode(att, location=(self.line_in_file, self.chunk_start))
+            node = AttributeNode(intern_name(att), location=self.location())
             self.temp_key_nodes.append(node)
-            if self.parent_node:
-                self.parent_node[-1].append(node)
+            self.add_attribute(node)
 
         if remainder:
             self.parse_outside_strings(remainder)
@@ -575,12 +1290,40 @@ class Parser:
         if segment.endswith(b"\n") and not self.skip_newlines_after_plus:
             self.temp_key_nodes = []
 
-    def parse(self) -> RootNode:
+    def parse(self, stream=None) -> RootNode:
         """
         Parse preprocessed WML into a tree of tags and attributes.
+        The input is read from stream (any binary file-like object
+        yielding lines) if given, else from the preprocessed file or
+        the file at self.path.
         """
+        if stream is None:
+            input = self.preprocessed
+            if not input: input = self.path
+            with open(input, "rb") as stream:
+                return self.parse(stream)
+
+        if self.engine not in ENGINES:
+            raise WMLError(self, "Unknown parser engine: " + str(self.engine))
+
+        self.reset_state()
+        if self.engine == "buffer":
+            self.parse_lines(stream.read())
+        else:
+            for rawline in stream:
+                self.parse_line(rawline, 0, len(rawline))
 
-        # parsing state
+        if self.keep_temp_dir is None and self.temp_dir:
+            if self.verbose:
+                print(("removing " + self.temp_dir))
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+        return self.root
+
+    def reset_state(self):
+        """
+        Resets the parsing state and creates a new, empty root node.
+        """
         self.temp_string = b""
         self.temp_string_node = None
         self.commas = 0
@@ -593,30 +1336,89 @@ class Parser:
         self.parent_node = [self.root]
         self.skip_newlines_after_plus = False
         self.in_tag = b""
+        # Where the buffer engine found the string it is in, see scan_once.
+        self.string_buf = None
+        self.string_start = 0
 
-        command_marker_byte = bytes([254])
-
-        input = self.preprocessed
-        if not input: input = self.path
+    def parse_lines(self, buf):
+        """
+        Parses all lines in the bytes buf.
+        """
+        pos = 0
+        n = len(buf)
+        while pos < n:
+            end = buf.find(b"\n", pos) + 1
+            if not end:
+                end = n
+            self.parse_line(buf, pos, end)
+            pos = end
+        self.flush_string(n)
+
+    def flush_string(self, end):
+        """
+        Moves the part of the string being scanned by the buffer engine
+        that ends at end into temp_string, when the string is not
+        continued right after it in the same buffer.
+        """
+        if self.string_buf is not None:
+            self.temp_string += self.string_buf[self.string_start:end]
+            self.string_buf = None
 
-        for rawline in open(input, "rb"):
-            compos = rawline.find(command_marker_byte)
-            self.parser_line += 1
-            # Everything from chr(254) to newline is the command.
-            if compos != 0:
+    def parse_line(self, buf, pos, end):
+        """
+        Parses the line of preprocessed WML at buf[pos:end], including
+        the trailing newline if there is one.
+        """
+        if self.engine == "buffer" and not (
+                self.temp_key_nodes or self.in_string or self.in_arrows or
+                self.in_tag):
+            simple = SIMPLE_LINE.match(buf, pos, end)
+            if simple:
+                self.parser_line += 1
                 self.line_in_file += 1
-            if compos >= 0:
-                self.parse_line_without_commands(rawline[:compos])
-                self.handle_command(rawline[compos + 1:-1])
-            else:
-                self.parse_line_without_commands(rawline)
+                self.parse_simple_line(buf, simple)
+                return
 
-        if self.keep_temp_dir is None and self.temp_dir:
-            if self.verbose:
-                print(("removing " + self.temp_dir))
-            shutil.rmtree(self.temp_dir, ignore_errors=True)
+        compos = buf.find(COMMAND_MARKER, pos, end)
+        self.parser_line += 1
+        # Everything from chr(254) to newline is the command.
+        if compos != pos:
+            self.line_in_file += 1
+        if compos < 0:
+            compos = end
+        if self.engine == "buffer":
+            self.scan(buf, pos, compos)
+        else:
+            self.parse_line_without_commands(buf[pos:compos])
+        if compos < end:
+            self.flush_string(compos)
+            self.handle_command(buf[compos + 1:end - 1])
 
-        return self.root
+    def parse_simple_line(self, buf, simple):
+        """
+        Handles a line of buf matched by SIMPLE_LINE the same way the
+        general tokenizer would.
+        """
+        slash, tag, key, value = simple.groups()
+        self.skip_newlines_after_plus = False
+        if key is None:
+            if slash:
+                self.close_tag(tag)
+            else:
+                self.open_tag(tag)
+            return
+        self.commas = 0
+        node = AttributeNode(intern_name(key), location=self.location())
+        self.add_attribute(node)
+        if len(value) < ZERO_COPY_MIN or b'""' in value:
+            value = value.replace(b'""', b'"')
+        else:
+            value = memoryview(buf)[simple.start(4):simple.end(4)]
+        string_node = StringNode(value)
+        if self.translatable:
+            string_node.textdomain = self.textdomain
+            self.translatable = False
+        node.value.append(string_node)
 
     def handle_command(self, com):
         if com.startswith(b"line "):
@@ -636,56 +1438,481 @@ class Parser:
         return self.root.get_text_val(name, default, translation)
 
 
-def jsonify(tree, verbose=False, depth=1):
+class WMLHandler:
+    """
+    Receives the events of a PushParser. All methods do nothing by
+    default, so a handler only needs to override what it is interested
+    in. Tag names are passed as bytes, the same as TagNode.name.
+    """
+
+    def start(self, name):
+        """
+        Called for an opening [name]. Returning SKIP makes the parser
+        skip everything up to the matching [/name], for which end is
+        still called.
+        """
+
+    def attribute(self, node):
+        """
+        Called with a complete AttributeNode once its whole value has
+        been parsed.
+        """
+
+    def end(self, name):
+        """
+        Called for a closing [/name].
+        """
+
+    def close(self):
+        """
+        Called when the PushParser is closed. The returned value is
+        passed on as the result of PushParser.close.
+        """
+
+
+class TreeBuilder(WMLHandler):
+    """
+    A WMLHandler which builds the same tree of nodes as the Parser.
+    """
+
+    def __init__(self):
+        self.root = RootNode()
+        self.parent_node = [self.root]
+
+    def start(self, name):
+        node = TagNode(name)
+        self.parent_node[-1].append(node)
+        self.parent_node.append(node)
+
+    def attribute(self, node):
+        self.parent_node[-1].append(node)
+
+    def end(self, name):
+        if len(self.parent_node) > 1:
+            self.parent_node.pop()
+
+    def close(self) -> RootNode:
+        return self.root
+
+
+class PushParser(Parser):
+    """
+    An incremental parser for preprocessed (or pure) WML. Instead of
+    parsing a whole file or string at once, data is pushed in with
+    feed as it arrives, for example directly from a socket:
+
+        p = PushParser(handler)
+        p.feed(b"[whisper]\nmessage=\"hi\"\n")
+        p.feed(b"sender=\"Elve\"\n[/whisper]\n")
+        p.close()
+
+    The handler (a WMLHandler) is called for each opening tag, each
+    complete attribute and each closing tag in document order, as soon
+    as the lines containing them are complete. No tree is built unless
+    the handler builds one; the default handler is a TreeBuilder, in
+    which case close returns the RootNode. Locations are not tracked
+    and the buffer engine is used.
+    """
+
+    def __init__(self, handler=None):
+        Parser.__init__(self, None)
+        self.track_locations = False
+        self.engine = "buffer"
+        if handler is None:
+            handler = TreeBuilder()
+        self.handler = handler
+        self.buffer = bytearray()
+        self.pending_attributes = []
+        # Depth inside a tag skipped by the handler, 0 if not skipping.
+        self.skipping = 0
+        self.reset_state()
+
+    def feed(self, chunk):
+        """
+        Parses all complete lines in chunk and keeps the remainder
+        until the next call to feed or close.
+        """
+        self.buffer += chunk
+        end = self.buffer.rfind(b"\n") + 1
+        if not end:
+            return
+        lines = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        self.parse_lines(lines)
+
+    def close(self):
+        """
+        Parses any remaining data and tells the handler that the
+        document is complete. Returns the result of handler.close().
+        """
+        if self.buffer:
+            self.parse_lines(bytes(self.buffer))
+            self.buffer.clear()
+        self.flush_attributes()
+        return self.handler.close()
+
+    def parse_line(self, buf, pos, end):
+        if self.skipping and self.is_skippable(buf, pos, end):
+            self.parser_line += 1
+            self.line_in_file += 1
+            return
+        Parser.parse_line(self, buf, pos, end)
+        # Attributes are complete once no assignment is continued on
+        # the next line.
+        if not (self.temp_key_nodes or self.in_string or self.in_arrows):
+            self.flush_attributes()
+
+    def is_skippable(self, buf, pos, end):
+        """
+        Whether the line buf[pos:end] can be dropped without tokenizing
+        it while inside a skipped tag: it must not open or close a tag,
+        start or end a multi-line value, or contain parser commands.
+        """
+        if self.temp_key_nodes or self.in_string or self.in_arrows or \
+                self.in_tag:
+            return False
+        stripped = buf[pos:end].strip()
+        return not stripped.startswith((b"[", b"#")) and \
+            not stripped.endswith(b"+") and \
+            stripped.count(b'"') % 2 == 0 and \
+            b"<<" not in stripped and \
+            COMMAND_MARKER not in stripped
+
+    def flush_attributes(self):
+        for node in self.pending_attributes:
+            self.handler.attribute(node)
+        self.pending_attributes = []
+
+    def open_tag(self, name):
+        self.flush_attributes()
+        if self.skipping:
+            self.skipping += 1
+        elif self.handler.start(intern_name(name)) is SKIP:
+            self.skipping = 1
+
+    def close_tag(self, name):
+        self.flush_attributes()
+        if self.skipping:
+            self.skipping -= 1
+            if self.skipping:
+                return
+        self.handler.end(name)
+
+    def add_attribute(self, node):
+        if not self.skipping:
+            self.pending_attributes.append(node)
+
+
+class TagDispatcher(WMLHandler):
+    """
+    A WMLHandler which only materializes the tags found at registered
+    paths and passes each of them, as a complete TagNode, to the
+    callback registered for its path:
+
+        d = TagDispatcher()
+        d.register("whisper", on_whisper)
+        d.register("*/command/speak", on_speak)
+        p = PushParser(d)
+        p.feed(data)
+        p.close()
+
+    Paths are "/"-separated tag names starting at the root, "*" matches
+    any tag name on its level. Tags which are neither registered nor
+    on the way to a registered path are skipped by the parser without
+    building any nodes. Attributes outside of registered tags are passed
+    to on_attribute, if set, together with the current path.
+    """
+
+    def __init__(self):
+        self.callbacks = {}
+        self.decisions = {}
+        self.on_attribute = None
+        self.reset()
+
+    def register(self, path, callback):
+        """
+        Calls callback with the TagNode of every tag at path.
+        """
+        self.callbacks[tuple(n.encode("utf8") for n in path.split("/"))] = \
+            callback
+        self.decisions.clear()
+
+    def reset(self):
+        """
+        Forgets the state of a partially dispatched document.
+        """
+        self.path = []
+        self.builder = None
+        self.depth = 0
+
+    def decide(self, path):
+        """
+        Returns the callback registered for path, True if a registered
+        path lies below path or None if path can be skipped.
+        """
+        below = None
+        for pattern, callback in self.callbacks.items():
+            if len(pattern) < len(path):
+                continue
+            for p, n in zip(pattern, path):
+                if p != b"*" and p != n:
+                    break
+            else:
+                if len(pattern) == len(path):
+                    return callback
+                below = True
+        return below
+
+    def start(self, name):
+        if self.builder:
+            self.depth += 1
+            self.builder.start(name)
+            return
+        self.path.append(name)
+        key = tuple(self.path)
+        if key not in self.decisions:
+            self.decisions[key] = self.decide(key)
+        decision = self.decisions[key]
+        if decision is None:
+            return SKIP
+        if decision is not True:
+            self.builder = TreeBuilder()
+            self.builder.start(name)
+            self.depth = 1
+
+    def attribute(self, node):
+        if self.builder:
+            self.builder.attribute(node)
+        elif self.on_attribute:
+            self.on_attribute(node, self.path)
+
+    def end(self, name):
+        if self.builder:
+            self.builder.end(name)
+            self.depth -= 1
+            if self.depth:
+                return
+            node = self.builder.root.data[0]
+            self.builder = None
+            callback = self.decisions[tuple(self.path)]
+            self.path.pop()
+            callback(node)
+        elif self.path:
+            self.path.pop()
+
+
+def jsonify(tree, verbose=False, depth=1, out=None):
     """
 Convert a Parser tree into JSON
 
 If verbose, insert a linebreak after every brace and comma (put every
 item on its own line), otherwise, condense everything into a single line.
+The JSON is written to out, by default sys.stdout, while walking the
+tree, the same as json.dumps(..., indent=depth) would format it. Tags
+become lists under their name, in the order the names first appear,
+followed by the attributes, where the last one of a name wins.
 """
     import json
-    def node_to_dict(n):
-        d = {}
-        tags = set(x.get_name() for x in n.get_all(tag=""))
-        for tag in tags:
-            d[tag] = [node_to_dict(x) for x in n.get_all(tag=tag)]
-        for att in n.get_all(att=""):
-            d[att.get_name()] = att.get_text()
-        return d
-
-    print(json.dumps(node_to_dict(tree), indent=depth if verbose else None))
-
-
-def xmlify(tree, verbose=False, depth=0):
-    import xml.etree.ElementTree as ET
+    write = (out or sys.stdout).write
+    if verbose:
+        separator = ","
+        newlines = lambda level: "\n" + " " * (depth * level)
+    else:
+        separator = ", "
+        newlines = lambda level: ""
+
+    def write_node(n, level):
+        atts = n.speedy_atts
+        names = [name for name in n.speedy_tags if name not in atts]
+        if not names and not atts:
+            write("{}")
+            return
+        write("{")
+        first = True
+        for name in names:
+            write(("" if first else separator) + newlines(level + 1) +
+                  json.dumps(name.decode("utf8")) + ": [")
+            first = False
+            for i, tag in enumerate(n.speedy_tags[name]):
+                write(("" if i == 0 else separator) + newlines(level + 2))
+                write_node(tag, level + 2)
+            write(newlines(level + 1) + "]")
+        for name, same in atts.items():
+            write(("" if first else separator) + newlines(level + 1) +
+                  json.dumps(name.decode("utf8")) + ": " +
+                  json.dumps(same[-1].get_text()))
+            first = False
+        write(newlines(level) + "}")
+
+    write_node(tree, 0)
+    write("\n")
+
+
+def xmlify(tree, verbose=False, depth=0, out=None):
+    """
+    Convert the first tag of a Parser tree into XML, written to out,
+    by default sys.stdout, while walking the tree. Every attribute
+    becomes an element holding its text, they come before the tags.
+    """
+    write = (out or sys.stdout).write
+
+    def escape(text):
+        if "&" in text:
+            text = text.replace("&", "&amp;")
+        if "<" in text:
+            text = text.replace("<", "&lt;")
+        if ">" in text:
+            text = text.replace(">", "&gt;")
+        return text
+
+    def write_node(n):
+        name = n.name.decode("utf8")
+        if not n.data:
+            write("<%s />" % name)
+            return
+        # The attributes of a tag are written at once, tags one by one.
+        parts = ["<%s>" % name]
+        for att in n.data:
+            if isinstance(att, AttributeNode):
+                text = att.get_text()
+                attname = att.name.decode("utf8")
+                if text:
+                    parts.append("<%s>%s</%s>" % (attname, escape(text), attname))
+                else:
+                    parts.append("<%s />" % attname)
+        write("".join(parts))
+        for tag in n.data:
+            if isinstance(tag, TagNode):
+                write_node(tag)
+        write("</%s>" % name)
+
+    write_node(tree.data[0])
+
+
+def parser_from_args(args):
+    """
+    Returns a Parser set up by the command line arguments.
+    """
+    p = Parser(args.wesnoth, args.config_dir, args.data_dir)
+    if args.keep_temp:
+        p.keep_temp_dir = args.keep_temp
+    if args.verbose: p.verbose = True
+    p.engine = args.engine
+    p.cache_dir = args.cache_dir
+    return p
 
-    def node_to_et(n):
-        et = ET.Element(n.get_name())
-        for att in n.get_all(att=""):
-            attel = ET.Element(att.get_name())
-            attel.text = att.get_text()
-            et.append(attel)
-        for tag in n.get_all(tag=""):
-            et.append(node_to_et(tag))
-        return et
 
-    ET.ElementTree(node_to_et(tree.get_all()[0])).write(
-        sys.stdout, encoding="unicode")
+def expand_inputs(inputs):
+    """
+    Returns the files named by the -i arguments, which can be files,
+    glob patterns or directories to search for .cfg files.
+    """
+    files = []
+    for pattern in inputs:
+        for path in sorted(glob.glob(pattern, recursive=True)) or [pattern]:
+            if not os.path.isdir(path):
+                files.append(path)
+                continue
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                files += [os.path.join(dirpath, filename)
+                          for filename in sorted(filenames)
+                          if filename.endswith(".cfg")]
+    return files
+
+
+def convert_file(job):
+    """
+    Parses one file in batch mode. job is the path and the command line
+    arguments. Returns the output for the file as text, or None and an
+    error message. This runs in the worker processes, so it only sends
+    text back instead of the tree.
+    """
+    path, args = job
+    p = parser_from_args(args)
+    try:
+        root = p.parse_file(path, args.defines)
+    except (WMLError, OSError) as e:
+        return None, "%s: %s" % (path, e)
+    out = io.StringIO()
+    try:
+        if args.to_json:
+            import json
+            jsonify(root, False, out=out)
+            # One line per file.
+            return '{"file": %s, "root": %s}\n' % (
+                json.dumps(path), out.getvalue().rstrip("\n")), None
+        elif args.to_xml:
+            from xml.sax.saxutils import quoteattr
+            if not root.get_all(tag=""):
+                return None, "%s: no tag to convert to XML" % path
+            xmlify(root, False, out=out)
+            return "<file path=%s>%s</file>\n" % (
+                quoteattr(path), out.getvalue()), None
+        return "# %s\n%s\n" % (path, root.debug()), None
+    except Exception as e:
+        # Raised in a worker it would end the whole batch.
+        return None, "%s: %s: %s" % (path, type(e).__name__, e)
+
+
+def convert_files(args, files):
+    """
+    Batch mode: parses files, using args.processes worker processes,
+    and writes the output for each to stdout as soon as it and all the
+    files before it are done. Returns whether all files were parsed.
+    """
+    jobs = [(path, args) for path in files]
+    processes = args.processes or os.cpu_count() or 1
+    executor = None
+    if processes > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(min(processes, len(jobs)))
+        results = executor.map(convert_file, jobs)
+    else:
+        results = map(convert_file, jobs)
+
+    ok = True
+    try:
+        if args.to_xml:
+            print('<?xml version="1.0" encoding="UTF-8" ?>')
+            print('<files>')
+        for output, error in results:
+            if error:
+                ok = False
+                print(error, file=sys.stderr)
+            else:
+                sys.stdout.write(output)
+                sys.stdout.flush()
+        if args.to_xml:
+            print('</files>')
+    finally:
+        if executor:
+            executor.shutdown()
+    return ok
 
 
 if __name__ == "__main__":
     arg = argparse.ArgumentParser()
     arg.add_argument("-a", "--data-dir", help="directly passed on to wesnoth.exe")
     arg.add_argument("-c", "--config-dir", help="directly passed on to wesnoth.exe")
-    arg.add_argument("-i", "--input", help="a WML file to parse")
+    arg.add_argument("-i", "--input", action="append",
+                     help="a WML file to parse, can be given more than once; "
+                          "directories and glob patterns are parsed in batch "
+                          "mode, with the output for each file on its own")
     arg.add_argument("-k", "--keep-temp", help="specify directory where to keep temp files")
+    arg.add_argument("-C", "--cache-dir", help="directory to cache preprocessed output in")
     arg.add_argument("-t", "--text", help="WML text to parse")
     arg.add_argument("-w", "--wesnoth", help="path to wesnoth.exe")
     arg.add_argument("-d", "--defines", help="comma separated list of WML defines")
+    arg.add_argument("-e", "--engine", choices=ENGINES, default="lines",
+                     help="parsing engine, the tests can be run with either")
     arg.add_argument("-T", "--test", action="store_true")
     arg.add_argument("-j", "--to-json", action="store_true")
     arg.add_argument("-v", "--verbose", action="store_true")
     arg.add_argument("-x", "--to-xml", action="store_true")
+    arg.add_argument("-P", "--processes", type=int, default=0,
+                     help="number of processes parsing files in batch mode, "
+                          "one per CPU by default (0), 1 to parse them in this one")
     args = arg.parse_args()
 
     if not args.input and not args.text and not args.test:
@@ -707,32 +1934,72 @@ if __name__ == "__main__":
         if args.keep_temp:
             p.keep_temp_dir = args.keep_temp
         if args.verbose: p.verbose = True
+        p.engine = args.engine
 
         only = None
+        failed = []
 
 
-        def test2(input, expected, note, function):
-            if only and note != only: return
-            input = input.strip()
-            expected = expected.strip()
-            p.parse_text(input)
-            output = function(p).strip()
-            if output != expected:
-                print("__________")
-                print(("FAILED " + note))
+        def report_failure(note, output, expected, input=None):
+            failed.append(note)
+            print("__________")
+            print(("FAILED " + note))
+            if input is not None:
                 print("INPUT:")
                 print(input)
-                print("OUTPUT:")
-                print(output)
-                print("EXPECTED:")
-                print(expected)
-                print("__________")
+            print("OUTPUT:")
+            print(output)
+            print("EXPECTED:")
+            print(expected)
+            print("__________")
+
+
+        def test2(input, expected, note, function, preprocessed=False):
+            """
+            preprocessed tests use #define or macros, which only
+            wesnoth expands, so they are skipped without -w.
+            """
+            if only and note != only: return
+            if preprocessed and not args.wesnoth:
+                print(("SKIPPED " + note + " (needs -w)"))
+                return
+            input = textwrap.dedent(input).strip()
+            expected = textwrap.dedent(expected).strip()
+            try:
+                p.parse_text(input)
+                output = function(p).strip()
+            except Exception:
+                output = traceback.format_exc().strip()
+            if output != expected:
+                report_failure(note, output, expected, input)
             else:
                 print(("PASSED " + note))
 
 
-        def test(input, expected, note):
-            test2(input, expected, note, lambda p: p.root.debug())
+        def test(input, expected, note, preprocessed=False):
+            test2(input, expected, note, lambda p: p.root.debug(), preprocessed)
+
+
+        def test_push(input, note):
+            """
+            Feeds input to a PushParser in small chunks and compares
+            the tree with the one built by the Parser.
+            """
+            if only and note != only: return
+            input = input.strip().encode("utf8")
+            expected = p.parse_binary(input).debug()
+            for size in (1, 7, len(input)):
+                try:
+                    push = PushParser()
+                    for i in range(0, len(input), size):
+                        push.feed(input[i:i + size])
+                    output = push.close().debug()
+                except Exception:
+                    output = traceback.format_exc().strip()
+                if output != expected:
+                    report_failure(note + " (chunk size %d)" % size, output, expected)
+                    return
+            print(("PASSED " + note))
 
 
         test(
@@ -798,7 +2065,7 @@ if __name__ == "__main__":
 [test]
     x=_<B>'abc' .. _<A>'abc'
 [/test]
-""", "textdomain")
+""", "textdomain", preprocessed=True)
 
         test(
             """
@@ -852,7 +2119,7 @@ if __name__ == "__main__":
             """,
             """
             foo='bar' .. 'baz'
-            """, "defined multi line string")
+            """, "defined multi line string", preprocessed=True)
 
         test(
             """
@@ -860,7 +2127,7 @@ if __name__ == "__main__":
             """,
             """
             foo='bar' .. 'baz'
-            """, "comment after +")
+            """, "comment after +", preprocessed=True)
 
         test(
             """
@@ -871,7 +2138,7 @@ if __name__ == "__main__":
             """,
             """
             foo='bar' .. 'baz'
-            """, "defined string concatenation")
+            """, "defined string concatenation", preprocessed=True)
 
         test(
             """
@@ -884,7 +2151,7 @@ if __name__ == "__main__":
             """
             [blah]
             [/blah]
-            """, "defined tag")
+            """, "defined tag", preprocessed=True)
 
         test2(
             """
@@ -899,14 +2166,315 @@ if __name__ == "__main__":
             p.get_all(tag="test")[0].get_text_val("a") + ", " +
             p.get_all(tag="test")[0].get_text_val("b"))
 
-        sys.exit(0)
+        test2(
+            """
+            [test]
+                a = "a ""quoted"" word"
+                [sub]
+                    b = 1
+                [/sub]
+            [/test]
+            """, """
+[test]
+a="a ""quoted"" word"
+[sub]
+b="1"
+[/sub]
+[/test]
+""", "writer", lambda p: p.root.wml().decode("utf8"))
 
-    p = Parser(args.wesnoth, args.config_dir, args.data_dir)
-    if args.keep_temp:
-        p.keep_temp_dir = args.keep_temp
-    if args.verbose: p.verbose = True
+        test_push(
+            """
+            [gamelist]
+                [game]
+                    id="1"
+                    name="a ""quoted"" name"
+                    map_data="border_size=1
+usage=map"
+                    [slot_data]
+                        max="2"
+                    [/slot_data]
+                [/game]
+            [/gamelist]
+            [user]
+                a, b = 1, 2
+                code = <<
+                    "quotes" here
+                >>
+                text = "bar" +
+                    "baz"
+            [/user]
+            """, "push parser")
+
+        row = ", ".join(["Gg^Efm", "Hh", "Re", "Ww"] * 64)
+        test_push(
+            """
+            [game]
+                map_data="border_size=1
+usage=map
+%s
+%s"
+                description="%s"
+                quoted="%s ""end"" x"
+                short="x"
+            [/game]
+            """ % (row, row, row, row), "push parser long values")
+
+        def dispatched(input):
+            found = []
+            d = TagDispatcher()
+            d.register("gamelist/game", lambda n: found.append(n.debug()))
+            d.register("*/command/speak", lambda n: found.append(n.debug()))
+            push = PushParser(d)
+            push.feed(input.strip().encode("utf8"))
+            push.close()
+            return "".join(found)
+
+        document = """
+            [scenario]
+                [event]
+                    [message]
+                        message="line
+[game]
+id=""2""
+[/game]"
+                    [/message]
+                    [lua]
+                        code = <<
+                            [game]
+                        >>
+                    [/lua]
+                [/event]
+                [gamelist]
+                    [game]
+                        id="3"
+                    [/game]
+                [/gamelist]
+            [/scenario]
+            [gamelist]
+                [game]
+                    id="1"
+                [/game]
+            [/gamelist]
+            [replay]
+                [command]
+                    [speak]
+                        message="hi"
+                    [/speak]
+                [/command]
+            [/replay]
+            """
+        test2(document, """
+[game]
+    id='1'
+[/game]
+[speak]
+    message='hi'
+[/speak]
+""", "dispatch", lambda p: dispatched(document))
+
+        def patched(p, diff):
+            apply_diff(p.root, Parser().parse_text(diff))
+            return p.root.debug()
+
+        test2("""
+[gamelist]
+    [game]
+        id="1"
+    [/game]
+    [game]
+        id="2"
+        name="old"
+    [/game]
+[/gamelist]
+[user]
+    name="a"
+[/user]
+x="1"
+[user]
+    name="b"
+[/user]
+""", """
+[gamelist]
+    [game]
+        id='3'
+    [/game]
+    [game]
+        id='2'
+        name='new'
+    [/game]
+[/gamelist]
+[user]
+    name='c'
+[/user]
+[user]
+    name='b'
+[/user]
+y='2'
+[user]
+    name='d'
+[/user]
+""", "diff", lambda p: patched(p, """
+[insert]
+    y="2"
+[/insert]
+[delete]
+    x="x"
+[/delete]
+[change_child]
+    index="0"
+    [gamelist]
+        [change_child]
+            index="1"
+            [game]
+                [insert]
+                    name="new"
+                [/insert]
+            [/game]
+        [/change_child]
+        [insert_child]
+            index="1"
+            [game]
+                id="3"
+            [/game]
+        [/insert_child]
+        [delete_child]
+            index="0"
+            [game]
+            [/game]
+        [/delete_child]
+    [/gamelist]
+[/change_child]
+[insert_child]
+    index="1"
+    [user]
+        name="c"
+    [/user]
+[/insert_child]
+[insert_child]
+    index="3"
+    [user]
+        name="d"
+    [/user]
+[/insert_child]
+[delete_child]
+    index="0"
+    [user]
+    [/user]
+[/delete_child]
+"""))
+
+        def selected(p):
+            root = p.root
+            lines = []
+            for path in ("gamelist/game/@id", "gamelist/game[id=2]/@name",
+                         "gamelist/game[observer=yes][1]/@id",
+                         "gamelist/game[observer]/slot_data/@vacant",
+                         "*/game[1]/@id", "gamelist/game[id=9]", "@x"):
+                lines.append("%s: %s" % (path, ",".join(root.select(path))
+                                         if "@" in path else
+                                         len(list(root.select(path)))))
+            gamelist = root.first("gamelist")
+            index = gamelist.value_index(b"game", b"id")
+            Parser().parse_text("[gamelist]\n[game]\nid=\"5\"\n[/game]\n[/gamelist]")
+            lines.append("index kept: %s" % (gamelist.value_index(b"game", b"id") is index))
+            game = root.first("gamelist/game[id=2]")
+            apply_diff(game, Parser().parse_text("[insert]\nid=\"9\"\n[/insert]"))
+            lines.append("changed: %s %s" % (root.first("gamelist/game[id=9]/@name"),
+                                             root.first("gamelist/game[id=2]")))
+            for path in ("game[", "game/", "game[x=]]", "game[-1]", "game/@"):
+                try:
+                    compile_path(path)
+                    lines.append("compiled " + path)
+                except ValueError:
+                    pass
+            return "\n".join(lines)
+
+        test2("""
+x="1"
+[gamelist]
+    [game]
+        id="1"
+        observer="yes"
+        [slot_data]
+            vacant="2"
+        [/slot_data]
+    [/game]
+    [game]
+        id="2"
+        name="two"
+    [/game]
+    [game]
+        id="3"
+        observer="yes"
+        [slot_data]
+            vacant="0"
+        [/slot_data]
+    [/game]
+[/gamelist]
+""", """
+gamelist/game/@id: 1,2,3
+gamelist/game[id=2]/@name: two
+gamelist/game[observer=yes][1]/@id: 3
+gamelist/game[observer]/slot_data/@vacant: 2,0
+*/game[1]/@id: 2
+gamelist/game[id=9]: 0
+@x: 1
+index kept: True
+changed: two None
+""", "select", selected)
+
+        def batch(options):
+            """
+            Converts a directory holding a file without tags in batch
+            mode, with two processes. That file fails on its own.
+            """
+            import contextlib
+            directory = tempfile.mkdtemp()
+            try:
+                for name, text in (("a.cfg", "[a]\nx=1\n[/a]\n"),
+                                   ("b.cfg", "x=2\n"),
+                                   ("c.cfg", "[c]\n[/c]\n")):
+                    with open(os.path.join(directory, name), "w") as f:
+                        f.write(text)
+                batch_args = arg.parse_args(["-i", directory, "-P", "2"] + options)
+                out, err = io.StringIO(), io.StringIO()
+                with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                    ok = convert_files(batch_args, expand_inputs(batch_args.input))
+                output = "ok: %s\n%s%s" % (ok, out.getvalue(), err.getvalue())
+                return output.replace(directory + os.sep, "")
+            finally:
+                shutil.rmtree(directory)
+
+        test2("", """
+ok: False
+<?xml version="1.0" encoding="UTF-8" ?>
+<files>
+<file path="a.cfg"><a><x>1</x></a></file>
+<file path="c.cfg"><c /></file>
+</files>
+b.cfg: no tag to convert to XML
+""", "batch xml", lambda p: batch(["-x"]))
+
+        test2("", """
+ok: True
+{"file": "a.cfg", "root": {"a": [{"x": "1"}]}}
+{"file": "b.cfg", "root": {"x": "2"}}
+{"file": "c.cfg", "root": {"c": [{}]}}
+""", "batch json", lambda p: batch(["-j"]))
+
+        if failed:
+            print("%d FAILED: %s" % (len(failed), ", ".join(failed)))
+        sys.exit(1 if failed else 0)
+
+    if args.input:
+        files = expand_inputs(args.input)
+        if files != args.input or len(files) > 1:
+            sys.exit(0 if convert_files(args, files) else 1)
+
+    p = parser_from_args(args)
     if args.input:
-        p.parse_file(args.input, args.defines)
+        p.parse_file(args.input[0], args.defines)
     elif args.text:
         p.parse_text(args.text, args.defines)
     if args.to_json: